@@ -6,4 +6,5 @@
 # All rights reserved.
 # ----------------------------------------------------------------------
 
-__all__ = ('compiler', 'error', 'java_method', 'java_type', 'lexer', 'parser')
\ No newline at end of file
+__all__ = ('compiler', 'error', 'java_method', 'java_type', 'lexer',
+           'parse_cache', 'parser', 'scanner', 'token_array')
\ No newline at end of file
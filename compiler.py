@@ -13,12 +13,26 @@
 
 from __future__ import with_statement
 from sets import Set
-from parser import parse_file
-import re, os, sys
+from parser import parse_file, scan_file
+from token_array import has_state_syntax
+import parser
+import re, os, sys, struct
 from java_type import JavaType
 from java_method import JavaMethod
 from error import JTypeError, JStateError
-import shutil
+from parse_cache import ParseCache
+from optparse import OptionParser
+from cStringIO import StringIO
+import shutil, filecmp, tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no reflinks
+
+# ioctl that makes a file share the data blocks of another (a reflink)
+# on filesystems that support it, e.g. Btrfs and XFS
+FICLONE = 0x40049409
 
 types = None             # string -> JavaType
 type_list = None         # List<JavaType>
@@ -26,13 +40,177 @@ interface_names = None   # Set<string>
 state_ids = None         # string -> int
 project_dir = None       # string
 method_ids = None        # {JavaMethod -> int}
+options = None           # optparse.Values
+
+# ids from the id map of a previous build, keyed by (kind, name); see
+# load_id_map. this is empty without the id-map option.
+saved_ids = None         # {(string, string) -> int}
+
+# number of output files written, and left alone because they already
+# held the generated code; see count_output.
+output_counts = None     # [int, int]
+
+# ways to place a verbatim copy of a class in the new project, best
+# first; see place_copy. a way is dropped once it fails.
+copy_methods = None      # List<string>
+
+# the hierarchy of each state class and, for each hierarchy, its state
+# classes, the local ids of the global state ids that it uses, its
+# number of method ids, the offset of its rows in SM.trans (always 0
+# with per-hierarchy transition tables), and its transition table.
+hierarchy_ids = None           # {JavaType -> int}
+hierarchy_classes = None       # List<List<JavaType>>
+hierarchy_numbers = None       # List<int>
+hierarchy_state_ids = None     # List<{int -> int}>
+hierarchy_num_methods = None   # List<int>
+hierarchy_offsets = None       # List<int>
+hierarchy_tables = None        # List<matrix>
+
+# for each hierarchy, the index of the body (see method_bodies) that each
+# transition in its table runs, or 0 for methods with one body
+hierarchy_bodies = None        # List<matrix>
+
+# in release mode, the hierarchies whose instances keep track of their
+# current state; see find_tracked_hierarchies.
+tracked_hierarchies = None     # Set<int>
+
+def make_option_parser():
+    """
+    make_option_parser(void) -> OptionParser
+    
+    Make the parser for the compiler's command-line options.
+    """
+    op = OptionParser(usage="%prog [options] [project_dir]")
+    op.add_option(
+        "--cache-dir", dest="cache_dir", metavar="DIR", default=None,
+        help="cache parsed files in DIR and reuse them when unchanged"
+    )
+    op.add_option(
+        "-j", "--jobs", dest="jobs", metavar="N", type="int", default=1,
+        help="parse files using N worker processes"
+    )
+    op.add_option(
+        "--codegen-jobs", dest="codegen_jobs", metavar="N", type="int",
+        default=1,
+        help="generate and write the new class files using N threads"
+    )
+    op.add_option(
+        "--copy-method", dest="copy_method", type="choice",
+        choices=("copy", "link"), default="copy",
+        help="copy classes without states into the new project, or hard " +
+             "link them (falling back to reflinks, then copies, where " +
+             "the filesystem can't)"
+    )
+    op.add_option(
+        "-O", "--optimize-lexer", dest="optimize_lexer", 
+        action="store_true", default=False,
+        help="build the lexer from cached tables (lextab.py)"
+    )
+    op.add_option(
+        "--scanner", dest="scanner", type="choice", 
+        choices=("ply", "fast"), default="ply",
+        help="scan files with the PLY lexer or the hand-written scanner"
+    )
+    op.add_option(
+        "-e", "--entry", dest="entries", metavar="NAME", action="append",
+        help="only parse the types reachable from the class or package " +
+             "NAME through imports and supertypes; can be repeated"
+    )
+    op.add_option(
+        "--source-root", dest="source_root", metavar="DIR", default=None,
+        help="directory that entry names are relative to (default: the " +
+             "parent of the project directory)"
+    )
+    op.add_option(
+        "--prescan", dest="prescan", action="store_true", default=False,
+        help="only fully parse state classes, their supertypes and their " +
+             "subtypes; other classes only have their headers parsed"
+    )
+    op.add_option(
+        "--table", dest="table", type="choice", 
+        choices=("dense", "comb", "flat"), default="dense",
+        help="layout of the state transition table in SM.java: a dense " +
+             "matrix, comb (row displacement) compressed arrays, or one " +
+             "flat array of the narrowest type that fits"
+    )
+    op.add_option(
+        "--dispatch", dest="dispatch", type="choice",
+        choices=("table", "switch"), default="table",
+        help="find the next state of a state method call in the " +
+             "transition table in SM.java, or in a switch over the " +
+             "current state in the method itself"
+    )
+    op.add_option(
+        "--fuse-dispatch", dest="fuse_dispatch", action="store_true",
+        default=False,
+        help="find both the next state and the body to run of a method " +
+             "with several bodies in one lookup, by packing the body " +
+             "index into its transitions"
+    )
+    op.add_option(
+        "--release", dest="release", action="store_true", default=False,
+        help="leave out the runtime state checks and exception handling " +
+             "of state methods; the current state is only kept where a " +
+             "method needs it to pick which body to run"
+    )
+    op.add_option(
+        "--split-tables", dest="split_tables", action="store_true",
+        default=False,
+        help="make one transition table per class hierarchy, with state " +
+             "and method ids local to the hierarchy"
+    )
+    op.add_option(
+        "--minimize-states", dest="minimize_states", action="store_true",
+        default=False,
+        help="merge states that behave the same into one table row"
+    )
+    op.add_option(
+        "--table-format", dest="table_format", type="choice",
+        choices=("java", "binary"), default="java",
+        help="write the transition tables as Java array literals in " +
+             "SM.java, or to a binary resource SM.bin that SM loads"
+    )
+    op.add_option(
+        "--id-map", dest="id_map", metavar="FILE", default=None,
+        help="keep the state, method and hierarchy ids and the table " +
+             "offsets in FILE so that they stay the same across builds; " +
+             "new ids are added after the saved ones (minimized tables " +
+             "still renumber their states)"
+    )
+    return op
 
-def compile_project(project_dir):
+def check_options():
     """
-    compile_project(string) -> void
+    check_options(void) -> void
+    
+    Warn about options that have no effect together with the others.
+    With switch dispatch there are no transition tables in SM.java, so
+    their layout and format don't matter, except that the flat layout
+    still gives the state fields the narrowest type.
+    """
+    if options.dispatch != "switch":
+        return
+    if options.table == "comb":
+        sys.stderr.write(
+            "WARNING: --table comb has no effect with --dispatch switch.\n"
+        )
+    if options.table_format == "binary":
+        sys.stderr.write(
+            "WARNING: --table-format binary has no effect with " +
+            "--dispatch switch.\n"
+        )
+
+def compile_project(project_dir, opts=None):
+    """
+    compile_project(string[, optparse.Values]) -> void
     
     Compile a state Java project into a Java project.
     """
+    global options
+    options = opts or make_option_parser().get_default_values()
+    parser.optimize_lexer = options.optimize_lexer
+    parser.scanner_backend = options.scanner
+    check_options()
     try:
         print "Compiling project '%s'..." % project_dir
         if parse_project(project_dir):
@@ -43,6 +221,7 @@ def compile_project(project_dir):
             rec_propagate(inherit_method_transitions)
             check_contracts()
             check_state_reachability()
+            release_sources()
 
             print "Generating Code..."
             new_project_dir = compile_classes()
@@ -56,6 +235,18 @@ def compile_project(project_dir):
         sys.stdout.flush()
         sys.stderr.write("Type Error: %s\n" % e)
 
+def release_sources():
+    """
+    release_sources(void) -> void
+    
+    Drop the source code of the types that turned out not to be state
+    classes. Code is only generated from the source of state classes;
+    the rest are copied from their files.
+    """
+    for klass in type_list:
+        if not len(klass.states):
+            klass.source = None
+
 def state_classes():
     """
     state_classes(void) -> Generator<JavaType>
@@ -83,8 +274,14 @@ def parse_project(root_dir):
     Begin parsing a Java project. This function expects to be given the
     path to the root directory of the project.
     
-    This function will then follow imports until no new Java files to
-    parse can be found.
+    If entry classes or packages were given then this function will
+    follow imports and supertypes from them until no new Java files to
+    parse can be found. Otherwise, every Java file in the project is
+    parsed.
+    
+    With the prescan option, files are first only parsed up to the end
+    of their class header, and then only the types that take part in
+    states are fully parsed; see parse_state_types.
     
     !!! This function expects there to be one and only one class per
         file.
@@ -93,52 +290,344 @@ def parse_project(root_dir):
         of if they are in entirely different sub-packages.
     """    
     global types, type_list, interface_names, state_ids
-    global method_ids, project_dir
+    global method_ids, project_dir, saved_ids
     
     types = { }
     type_list = [ ]
     interface_names = Set()
     state_ids = { }
     method_ids = { }
+    saved_ids = options.id_map and load_id_map(options.id_map) or { }
+    next_state_id = max([
+        i + 1 for (kind, _), i in saved_ids.items() if kind == "state"
+    ] or [0])
     
     is_java_file = re.compile(".*\.java$")
     project_dir = os.path.abspath(root_dir)
     had_errors = False
+    cache = options.cache_dir and ParseCache(options.cache_dir) or None
     
     if not os.path.isdir(project_dir):
         raise Exception("Invalid directory supplied: %s." % project_dir)
     
-    # go and discover files to parse
-    for dir_name, dir_names, file_names in os.walk(project_dir):            
-        for file_name in file_names:
+    if options.prescan:
+        parse = scan_files
+    else:
+        parse = lambda file_paths: parse_files(file_paths, cache)
+    
+    if options.entries:
+        klasses = parse_reachable(
+            options.source_root or os.path.dirname(project_dir),
+            options.entries,
+            parse
+        )
+    else:
+        # go and discover files to parse, in a fixed order
+        file_paths = [ ]
+        for dir_name, dir_names, file_names in os.walk(project_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if is_java_file.match(file_name):
+                    file_paths.append(os.path.join(dir_name, file_name))
+        klasses = parse(file_paths)
+    
+    if options.prescan:
+        klasses = parse_state_types(klasses, cache)
+    
+    # types are merged in discovery order, regardless of the order in
+    # which they were parsed, so that type ids are deterministic
+    for klass in klasses:
+        if klass:
+            klass.register()
+            if klass.name in types:
+                raise JTypeError(
+                    ("Two Java types cannot be named the same; " +
+                     "in %s and %s.")
+                    % (klass.file, types[klass.name].file)
+                )
             
-            if not is_java_file.match(file_name):
-                continue
+            types[klass.name] = klass
             
-            klass = parse_file(os.path.join(dir_name, file_name))
-            if klass:
-                if klass.name in types:
-                    raise JTypeError(
-                        ("Two Java types cannot be named the same; " +
-                         "in %s and %s.")
-                        % (klass.file, types[klass.name].file)
-                    )
-                
-                types[klass.name] = klass
-                type_list.insert(klass.id, klass)
-                
-                # collect inteface names (for later)
-                if klass.is_interface:
-                    interface_names.add(klass.name)
+            # only state classes are compiled from their source; a type
+            # that neither declares states nor can inherit them is
+            # copied from its file
+            if not len(klass.states) and not len(klass.parents):
+                klass.source = None
+            type_list.insert(klass.id, klass)
+            
+            # collect inteface names (for later)
+            if klass.is_interface:
+                interface_names.add(klass.name)
 
-                # collect all of the states (for later)
-                for state in klass.states:
-                    if state not in state_ids:
-                        state_ids[state] = len(state_ids)
-            else:
-                had_errors = True
+            # collect all of the states (for later), reusing saved ids
+            for state in sorted(klass.states):
+                if state not in state_ids:
+                    saved_id = saved_ids.get(("state", state))
+                    if saved_id is None:
+                        saved_id = next_state_id
+                        next_state_id += 1
+                    state_ids[state] = saved_id
+        else:
+            had_errors = True
     return not had_errors
 
+def parse_files(file_paths, cache, sources=None):
+    """
+    parse_files(list, ParseCache | None[, list]) -> list
+    
+    Parse a list of Java files and return the list of their types, in
+    the same order as file_paths. A file with parse errors has None as
+    its type. Types are taken from the parse cache where the file is
+    unchanged, and the remaining files are parsed by a pool of worker
+    processes if more than one job is allowed.
+    
+    Every file is read once, here, unless its source code is given in
+    sources; the types keep their source code for code generation.
+    
+    !!! The returned types need to be registered before they are used.
+    """
+    klasses = [None] * len(file_paths)
+    to_parse = [ ]
+    missed = [ ] # indices of the files in to_parse
+    
+    for i, file_path in enumerate(file_paths):
+        if sources:
+            source = sources[i]
+        else:
+            with open(file_path) as f:
+                source = f.read()
+        klass = cache and cache.load(file_path, source)
+        if klass:
+            print "Loaded file:", file_path
+            klass.source = source
+            klasses[i] = klass
+        else:
+            to_parse.append((file_path, source))
+            missed.append(i)
+    
+    if options.jobs > 1 and len(to_parse) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(options.jobs, len(to_parse)))
+        try:
+            results = pool.map(
+                parse_worker, 
+                to_parse, 
+                len(to_parse) // (options.jobs * 4) + 1
+            )
+        finally:
+            pool.close()
+            pool.join()
+        
+        # replay the output of the workers in file order
+        for _, out, err in results:
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+        parsed = [klass for klass, _, _ in results]
+    else:
+        parsed = [parse_file(*args) for args in to_parse]
+    
+    for i, (file_path, source), klass in zip(missed, to_parse, parsed):
+        klasses[i] = klass
+        if klass:
+            klass.source = source # not sent back by the workers
+            if cache:
+                cache.store(file_path, source, klass)
+    
+    return klasses
+
+def scan_files(file_paths):
+    """
+    scan_files(list) -> list
+    
+    Parse only the imports and class headers of a list of Java files and
+    return the list of their types, in the same order as file_paths.
+    This is cheap enough that it is not cached or done in parallel.
+    """
+    return [scan_file(file_path) for file_path in file_paths]
+
+def parse_state_types(klasses, cache):
+    """
+    parse_state_types(list, ParseCache | None) -> list
+    
+    Fully parse the types, out of a list of types with only their headers
+    parsed, that take part in states: the types that declare or use
+    states, and all of their supertypes and subtypes. Returns the list
+    of types with these types replaced; the rest are left as they are
+    and are copied into the new project as-is.
+    """
+    by_name = { }
+    children = { }
+    for klass in klasses:
+        if klass:
+            by_name[klass.name] = klass
+            for parent in klass.parents:
+                children.setdefault(parent, [ ]).append(klass.name)
+    
+    def parents_of(name):
+        return name in by_name and by_name[name].parents or ()
+    
+    def children_of(name):
+        return children.get(name, ())
+    
+    # follow the supertypes and subtypes of the state types separately;
+    # the subtypes of a supertype of a state type don't need states
+    state_names = [
+        klass.name for klass in klasses 
+        if klass and has_state_syntax(klass.source)
+    ]
+    needed = Set(state_names)
+    for related in (parents_of, children_of):
+        seen = Set(state_names)
+        work = list(state_names)
+        while work:
+            for name in related(work.pop()):
+                if name not in seen:
+                    seen.add(name)
+                    work.append(name)
+        needed.update(seen)
+    
+    indices = [
+        i for i, klass in enumerate(klasses) 
+        if klass and klass.name in needed
+    ]
+    parsed = parse_files(
+        [klasses[i].file for i in indices],
+        cache,
+        [klasses[i].source for i in indices]
+    )
+    
+    klasses = list(klasses)
+    for i, klass in zip(indices, parsed):
+        klasses[i] = klass
+    return klasses
+
+def parse_reachable(root_dir, entries, parse):
+    """
+    parse_reachable(string, list, function) -> list
+    
+    Parse the Java files of the entry classes and packages (named
+    relative to root_dir), then the files of the types that they import
+    or extend/implement, and so on until no new files are found. Only
+    files in the project directory are parsed. The files are parsed by
+    calling parse(file_paths), e.g. using parse_files, which must at
+    least parse the imports and class headers. Returns the types in the
+    order that their files were found.
+    """
+    file_paths = [ ]
+    for entry in entries:
+        entry_paths = resolve_name(os.path.abspath(root_dir), entry)
+        if not entry_paths:
+            raise Exception("Unknown entry class or package: %s." % entry)
+        file_paths.extend(entry_paths)
+    
+    klasses = [ ]
+    seen = Set()
+    while file_paths:
+        
+        # parse the newly found files together
+        to_parse = [ ]
+        for file_path in file_paths:
+            if file_path not in seen and in_project(file_path):
+                seen.add(file_path)
+                to_parse.append(file_path)
+        parsed = parse(to_parse)
+        klasses.extend(parsed)
+        
+        file_paths = [ ]
+        for klass in parsed:
+            if klass:
+                file_paths.extend(type_dependencies(klass))
+    
+    return klasses
+
+def in_project(file_path):
+    """
+    in_project(string) -> Bool
+    
+    Check if a file is in the project directory.
+    """
+    return file_path.startswith(os.path.join(project_dir, ""))
+
+def resolve_name(root_dir, name):
+    """
+    resolve_name(string, string) -> list
+    
+    Find the Java files for a class or package name, e.g. "a.b.C",
+    "a.b" or "a.b.*", relative to root_dir. A name that is not a class
+    or package is assumed to name a member of a class (as in a static
+    import) and the class is used. Returns an empty list if no files
+    could be found.
+    """
+    parts = name.split(".")
+    if parts[-1] == "*":
+        parts.pop()
+    is_member = False
+    while parts:
+        path = os.path.join(root_dir, *parts)
+        if os.path.isfile(path + ".java"):
+            return [path + ".java"]
+        if os.path.isdir(path) and not is_member:
+            return [
+                os.path.join(path, file_name)
+                for file_name in sorted(os.listdir(path))
+                if file_name.endswith(".java")
+            ]
+        parts.pop()
+        is_member = True
+    return [ ]
+
+def type_dependencies(klass):
+    """
+    type_dependencies(JavaType) -> list
+    
+    Find the Java files that a parsed type depends on: the files of the
+    classes that it imports and of its supertypes. Wildcard imports are
+    only used to find supertypes; the rest of the files in an imported
+    package are not needed.
+    """
+    
+    # the directory that the type's package names are relative to
+    root_dir = os.path.dirname(klass.file)
+    if klass.package:
+        for _ in klass.package.split("."):
+            root_dir = os.path.dirname(root_dir)
+    
+    file_paths = [ ]
+    package_dirs = [os.path.dirname(klass.file)]
+    for name in klass.imports:
+        if name.endswith(".*"):
+            package_dirs.append(os.path.join(root_dir, *name.split(".")[:-1]))
+        else:
+            file_paths.extend(resolve_name(root_dir, name))
+    
+    # supertypes are found in the type's own package first, then in the
+    # packages imported with wildcards. supertypes that are imported by
+    # name were found above.
+    for parent in sorted(klass.parents):
+        for package_dir in package_dirs:
+            file_path = os.path.join(package_dir, "%s.java" % parent)
+            if os.path.isfile(file_path):
+                file_paths.append(file_path)
+                break
+    
+    return file_paths
+
+def parse_worker(args):
+    """
+    parse_worker((string, string)) -> (JavaType | None, string, string)
+    
+    Parse a single file in a worker process. Anything that the parser
+    writes to stdout or stderr is captured and returned along with the
+    type so that the parent process can write it out in order.
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        klass = parse_file(*args)
+        return klass, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
 def check_parents():
     """
     check_parents(void) -> void
@@ -396,78 +885,897 @@ def check_state_reachability():
                 % (", ".join(unreachable), klass.name, klass.file)
             )
 
-def make_trans_table():
+def make_hierarchies():
     """
-    make_trans_table(void) -> matrix
+    make_hierarchies(void) -> void
     
-    Make the state transition table. The table is used as:
+    Group the state classes into connected class hierarchies. The states
+    used in each hierarchy get local ids, in the same order as their
+    global ids, and the (non-constructor) method sets of each hierarchy
+    are numbered from zero. Only the classes in a hierarchy use its ids,
+    so unrelated hierarchies reuse the same state and method ids.
+    
+    Each hierarchy also gets a number, which names its tables in SM.java
+    when they are split. Hierarchies, states and method sets that have
+    saved ids or numbers keep them, and come before new ones. Ids that
+    are no longer used are left as gaps in the numbering until the id
+    map is removed. Minimizing the tables renumbers the states, so saved
+    local state ids are then not used.
+    """
+    global hierarchy_ids, hierarchy_classes, hierarchy_numbers
+    global hierarchy_state_ids, hierarchy_num_methods
+    hierarchy_ids = { }
+    hierarchy_classes = [ ]
+    hierarchy_numbers = [ ]
+    hierarchy_state_ids = [ ]
+    hierarchy_num_methods = [ ]
+    
+    children = { }
+    for klass in state_classes():
+        for parent in klass.parents:
+            children.setdefault(parent, [ ]).append(klass)
+    
+    for klass in state_classes():
+        if klass in hierarchy_ids:
+            continue
+        
+        # find the rest of the hierarchy
+        hierarchy_ids[klass] = None
+        members = [klass]
+        work = [klass]
+        while work:
+            member = work.pop()
+            related = [types[parent] for parent in member.parents]
+            related.extend(children.get(member.name, ()))
+            for other in related:
+                if other not in hierarchy_ids and len(other.states):
+                    hierarchy_ids[other] = None
+                    members.append(other)
+                    work.append(other)
+        members.sort(key=lambda member: member.id)
+        hierarchy_classes.append(members)
+    
+    # saved hierarchies first, in their saved order
+    def saved_order(members):
+        return min(
+            saved_ids.get(("hierarchy", member.name), sys.maxint)
+            for member in members
+        )
+    hierarchy_classes.sort(key=saved_order)
+    
+    # keep the saved numbers, leaving gaps for removed hierarchies
+    next_number = max(
+        [i + 1 for (kind, name), i in saved_ids.items()
+         if kind == "hierarchy"] or [0]
+    )
+    for members in hierarchy_classes:
+        number = saved_order(members)
+        if number == sys.maxint or number in hierarchy_numbers:
+            number = next_number
+            next_number += 1
+        hierarchy_numbers.append(number)
+    
+    for h, members in enumerate(hierarchy_classes):
+        states = Set()
+        for member in members:
+            hierarchy_ids[member] = h
+            states.update(member.states)
+        
+        # number the states
+        local_ids = { }
+        taken = Set()
+        new_states = [ ]
+        for state in sorted(states, key=state_ids.get):
+            saved_id = None
+            if not options.minimize_states:
+                saved_id = saved_class_id("local-state", members, state)
+            if saved_id is not None and saved_id not in taken:
+                local_ids[state_ids[state]] = saved_id
+                taken.add(saved_id)
+            else:
+                new_states.append(state)
+        num_states = max([i + 1 for i in taken] or [0])
+        for state in new_states:
+            local_ids[state_ids[state]] = num_states
+            num_states += 1
+        hierarchy_state_ids.append(local_ids)
+        
+        # number the method sets, class by class
+        taken = Set()
+        new_sets = [ ]
+        for member in members:
+            for method_set in member.method_sets():
+                if iter(method_set).next().is_constructor:
+                    continue
+                name = method_set_name(method_set)
+                saved_id = saved_ids.get(("method", name))
+                if saved_id is not None and saved_id not in taken:
+                    method_set.id = saved_id
+                    taken.add(saved_id)
+                else:
+                    new_sets.append(method_set)
+        num_methods = max([i + 1 for i in taken] or [0])
+        for method_set in new_sets:
+            method_set.id = num_methods
+            num_methods += 1
+        hierarchy_num_methods.append(num_methods)
+
+def saved_class_id(kind, members, name=""):
+    """
+    saved_class_id(string, list[, string]) -> int
+    
+    Get the id of a kind saved for a name in a hierarchy, e.g. the local
+    id of a state, from the first of the hierarchy's classes that has
+    one. Returns None if none of them has one.
+    """
+    for member in members:
+        saved_id = saved_ids.get((kind, member.name + name))
+        if saved_id is not None:
+            return saved_id
+    return None
+
+def method_set_name(method_set):
+    """
+    method_set_name(JavaMethodSet) -> string
+    
+    Get the name of a method set in the id map, e.g. "Foo.bar(void,int)"
+    for the methods "void bar(int x)" of class Foo.
+    """
+    method = iter(method_set).next()
+    return "%s.%s(%s)" % (
+        method.klass.name, method.name, ",".join(method.signature)
+    )
+
+def load_id_map(file_name):
+    """
+    load_id_map(string) -> dict
+    
+    Load the ids saved by save_id_map, keyed by (kind, name), where the
+    kind is "state", "method", "hierarchy", "offset" (of a class's rows
+    in the project-wide table) or "local-state" (named by a class and a
+    state, e.g. "Foo:A"). A missing id map is empty.
+    """
+    ids = { }
+    if not os.path.exists(file_name):
+        return ids
+    with open(file_name) as f:
+        for line in f:
+            kind, name, i = line.rstrip("\n").split("\t")
+            ids[(kind, name)] = int(i)
+    return ids
+
+def save_id_map(file_name):
+    """
+    save_id_map(string) -> void
+    
+    Save the state ids, method set ids, hierarchy numbers, table offsets
+    and local state ids of this build, along with the saved ids that were
+    not used in it, as one tab-separated "kind, name, id" line each. The
+    local state ids of minimized tables are not saved.
+    """
+    ids = dict(saved_ids)
+    for state, i in state_ids.items():
+        ids[("state", state)] = i
+    for klass, h in hierarchy_ids.items():
+        ids[("hierarchy", klass.name)] = hierarchy_numbers[h]
+        if not options.split_tables:
+            ids[("offset", klass.name)] = hierarchy_offsets[h]
+        for state in klass.states:
+            if not options.minimize_states:
+                ids[("local-state", klass.name + state)] = (
+                    hierarchy_state_ids[h][state_ids[state]]
+                )
+        for method_set in klass.method_sets():
+            if method_set.id is not None:
+                ids[("method", method_set_name(method_set))] = method_set.id
+    
+    f = StringIO()
+    for (kind, name), i in sorted(ids.items()):
+        f.write("%s\t%s\t%d\n" % (kind, name, i))
+    write_if_changed(file_name, f.getvalue())
+
+def state_id(klass, state):
+    """
+    state_id(JavaType, string) -> int
+    
+    Get the id of a state as used in the code of a state class.
+    """
+    h = hierarchy_ids[klass]
+    return hierarchy_state_ids[h][state_ids[state]] + hierarchy_offsets[h]
+
+def method_id(klass, method):
+    """
+    method_id(JavaType, JavaMethod) -> int
+    
+    Get the id of a method as used in the code of a state class.
+    """
+    return method_ids[method]
+
+def table_suffix(klass):
+    """
+    table_suffix(JavaType) -> string
+    
+    Get the suffix of the names of the transition table and state names
+    in SM.java that a state class uses: its hierarchy's number.
+    """
+    if not options.split_tables:
+        return ""
+    return str(hierarchy_numbers[hierarchy_ids[klass]])
+
+def make_trans_table(h):
+    """
+    make_trans_table(int) -> (matrix, matrix)
+    
+    Make the state transition table of a hierarchy. The table is used as:
     [current-state-id][current-method-id] -> new-state-id
     Each method id represents a method set, and each state id represents
-    one of the various states.
+    one of the various states, both local to the hierarchy.
+    
+    Also make a matrix like the table, but holding the method whose body
+    runs for each transition (or None) instead of the new state id.
+    Within a method set, different from-states may run the bodies of
+    different methods.
+    
+    Local state ids that are not used (see make_hierarchies) get rows
+    that disallow every method.
     """
-    m = [ ]
-    num_methods = len(method_ids)
+    local_state_ids = hierarchy_state_ids[h]
+    num_methods = hierarchy_num_methods[h]
+    num_states = max(local_state_ids.values() + [-1]) + 1
+    m = [[-1] * num_methods for _ in range(num_states)]
+    bodies = [[None] * num_methods for _ in range(num_states)]
     
-    # build the base table
-    for _ in state_ids:
-        m.append([-1] * num_methods)
+    # collect the methods. this will collect the same method several
+    # times (as a result of inheritance / many start states), but 
+    # that's not an issue! transitions are deterministic, so the order
+    # of the classes doesn't matter.
+    for klass in hierarchy_classes[h]:
+        for from_state, to_state, method in klass.transitions():
+            if not method.is_constructor:
+                i = local_state_ids[state_ids[from_state]]
+                j = method_ids[method]
+                m[i][j] = local_state_ids[state_ids[to_state]]
+                bodies[i][j] = method
     
-    def add_transitions(_, klass):
-        # collect the methods. this will collect the same method several
-        # times (as a result of inheritance / many start states), but 
-        # that's not an issue!
-        for klass in state_classes():
-            for from_state, to_state, method in klass.transitions():
-                if not method.is_constructor:
-                    j = m[state_ids[from_state]][method_ids[method]]
-                    m[state_ids[from_state]][method_ids[method]] = state_ids[to_state]
+    return m, bodies
+
+def place_trans_tables(tables):
+    """
+    place_trans_tables(list) -> int
     
-    # this is to make sure that we add the transitions in the correct order
-    rec_propagate(add_transitions)
+    Set the offsets in hierarchy_offsets at which the rows of each
+    hierarchy start in the project-wide table, and return the number of
+    rows of that table. A hierarchy keeps its saved offset if its rows
+    still fit before the saved offset of the next one, and the others go
+    after the last row, so that a hierarchy gaining states doesn't move
+    the rows of another one.
+    """
+    global hierarchy_offsets
+    hierarchy_offsets = [None] * len(tables)
+    saved = [
+        saved_class_id("offset", members) for members in hierarchy_classes
+    ]
+    placed = [ ]
+    for h, m in enumerate(tables):
+        offset = saved[h]
+        if offset is None:
+            continue
+        end = offset + len(m)
+        overlaps = [
+            start for start, stop in placed if start < end and offset < stop
+        ]
+        overlaps.extend(
+            i for i in saved if i is not None and offset < i < end
+        )
+        if not overlaps:
+            hierarchy_offsets[h] = offset
+            placed.append((offset, end))
+    num_rows = max([stop for start, stop in placed] or [0])
+    for h, m in enumerate(tables):
+        if hierarchy_offsets[h] is None:
+            hierarchy_offsets[h] = num_rows
+            num_rows += len(m)
+    return num_rows
+
+def stack_trans_tables(tables):
+    """
+    stack_trans_tables(list) -> matrix
     
-    return m
+    Stack the transition tables of all hierarchies into one project-wide
+    table. The rows of each hierarchy start at its offset (see
+    place_trans_tables), and its state ids are shifted by the same
+    offset; rows between hierarchies disallow every method. Method ids
+    are shared by the hierarchies, so the table is only as wide as the
+    widest hierarchy's table.
+    """
+    num_rows = place_trans_tables(tables)
+    width = max(trans_table_stride(m) for m in tables)
+    stacked = [[-1] * width for _ in range(num_rows)]
+    for m, offset in zip(tables, hierarchy_offsets):
+        for i, row in enumerate(m):
+            for j, to_state in enumerate(row):
+                if to_state >= 0:
+                    stacked[offset + i][j] = to_state + offset
+    return stacked
+
+def minimize_trans_table(m, bodies):
+    """
+    minimize_trans_table(matrix, matrix) -> (matrix, list)
+    
+    Merge the states of a state transition table that cannot be told
+    apart: for every method they either both disallow it, or both allow
+    it, run the same method body (per the bodies matrix made alongside
+    the table by make_trans_table), and move to states that cannot be
+    told apart. This is DFA minimization by
+    partition refinement (Moore's algorithm).
+    
+    Returns the minimized table and a list mapping each state id of m to
+    its state id in the minimized table. New ids are given in order of
+    the smallest old id that they replace.
+    """
+    num_methods = len(m) and len(m[0]) or 0
+    
+    def renumber(keys):
+        ids = { }
+        return [ids.setdefault(key, len(ids)) for key in keys]
+    
+    # start by splitting the states on what each method does in them
+    rows = renumber(
+        tuple((m[i][j] >= 0, bodies[i][j]) for j in range(num_methods))
+        for i in range(len(m))
+    )
+    
+    # then split the groups of states until each group's states move to
+    # the same groups of states
+    while True:
+        new_rows = renumber(
+            (rows[i], tuple(
+                to_state >= 0 and (rows[to_state],) or () 
+                for to_state in m[i]
+            ))
+            for i in range(len(m))
+        )
+        if max(new_rows + [-1]) == max(rows + [-1]):
+            break
+        rows = new_rows
+    
+    min_m = [None] * (max(rows + [-1]) + 1)
+    for i, row in enumerate(rows):
+        if min_m[row] is None:
+            min_m[row] = [-1] * num_methods
+            for j, to_state in enumerate(m[i]):
+                if to_state >= 0:
+                    min_m[row][j] = rows[to_state]
+    return min_m, rows
+
+def state_names(ids):
+    """
+    state_names(list) -> list
+    
+    Get the names of the states with each id, given a list of (name, id)
+    pairs, with None for unused ids. The names of states that were merged
+    into one id by minimize_trans_table are joined with "or".
+    """
+    names = { }
+    for name, i in sorted(ids):
+        names.setdefault(i, [ ]).append(name)
+    return [
+        i in names and " or ".join(names[i]) or None
+        for i in range(max(names.keys() + [-1]) + 1)
+    ]
+
+def compress_trans_table(m):
+    """
+    compress_trans_table(matrix) -> (list, list, list)
+    
+    Compress the state transition table using row displacement (comb
+    compression). The rows are overlaid onto one another in a single
+    array, each row i starting at base[i], such that no two defined
+    (non -1) entries share a slot. The table is then used as:
+    
+        k = base[current-state-id] + current-method-id
+        new-state-id = check[k] == current-state-id ? next[k] : -1
+    
+    Returns (base, next, check). next and check are padded so that k is
+    always in bounds. Every entry of m is checked to decode back from
+    them; see comb_lookup.
+    """
+    num_methods = len(m) and len(m[0]) or 0
+    base = [0] * len(m)
+    next = [ ]
+    check = [ ]
+    
+    # place the densest rows first; they are the hardest to fit
+    rows = [ ]
+    for i, row in enumerate(m):
+        cols = [j for j, to_state in enumerate(row) if to_state >= 0]
+        if cols:
+            rows.append((-len(cols), i, cols))
+    rows.sort()
+    
+    first_free = 0
+    for _, i, cols in rows:
+        b = max(first_free - cols[0], 0)
+        while True:
+            for j in cols:
+                if b + j < len(check) and check[b + j] >= 0:
+                    break
+            else:
+                break
+            b += 1
+        
+        base[i] = b
+        end = b + cols[-1] + 1
+        if end > len(check):
+            next.extend([-1] * (end - len(check)))
+            check.extend([-1] * (end - len(check)))
+        for j in cols:
+            next[b + j] = m[i][j]
+            check[b + j] = i
+        while first_free < len(check) and check[first_free] >= 0:
+            first_free += 1
+    
+    size = max(base + [0]) + num_methods
+    next.extend([-1] * (size - len(next)))
+    check.extend([-1] * (size - len(check)))
+    
+    for i, row in enumerate(m):
+        for j, to_state in enumerate(row):
+            assert comb_lookup(base, next, check, i, j) == to_state, \
+                "comb table entry (%d, %d) does not decode" % (i, j)
+    return base, next, check
+
+def comb_lookup(base, next, check, i, j):
+    """
+    comb_lookup(list, list, list, int, int) -> int
+    
+    Look up a transition in a table compressed by compress_trans_table,
+    the same way as the code in SM.java does.
+    """
+    k = base[i] + j
+    if check[k] == i:
+        return next[k]
+    return -1
+
+def state_type(num_states):
+    """
+    state_type(int) -> string
+    
+    Get the narrowest Java integer type that can hold the ids of
+    num_states states, as well as -1.
+    """
+    if num_states <= 128:
+        return "byte"
+    if num_states <= 32768:
+        return "short"
+    return "int"
+
+def trans_table_arrays(m, suffix=""):
+    """
+    trans_table_arrays(matrix[, string]) -> list
+    
+    Get the arrays that make up a state transition table in SM.java, in
+    the layout chosen by the table option, as a list of (name, type,
+    values) triples. type is the Java element type, and values is a
+    list of ints, or a matrix for a two-dimensional array. The names of
+    the arrays end in suffix.
+    
+    The flat layout is a single array indexed by
+    [current-state-id * stride + current-method-id], where stride is
+    the number of methods, of the narrowest type that fits the states.
+    """
+    if options.table == "comb":
+        base, next, check = compress_trans_table(m)
+        return [
+            ("base" + suffix, "int", base), 
+            ("next" + suffix, "int", next), 
+            ("check" + suffix, "int", check),
+        ]
+    elif options.table == "flat":
+        values = [to_state for row in m for to_state in row]
+        return [(
+            "trans" + suffix, 
+            state_type(max([len(m)] + [value + 1 for value in values])), 
+            values
+        )]
+    return [("trans" + suffix, "int", m)]
+
+def method_bodies(method_set):
+    """
+    method_bodies(JavaMethodSet) -> list
+    
+    Get the methods of a method set, in the order that their bodies are
+    compiled in. The index of a body is its index in this list.
+    """
+    return sorted(method_set, key=lambda method: method.header_span)
+
+def body_index_table(bodies):
+    """
+    body_index_table(matrix) -> matrix
+    
+    Turn the matrix of the methods run by each transition (see
+    make_trans_table) into a matrix of the indices of their bodies in
+    their method sets, with 0 for disallowed transitions.
+    """
+    indices = { }
+    b = [ ]
+    for row in bodies:
+        b_row = [ ]
+        for method in row:
+            if method is None:
+                b_row.append(0)
+                continue
+            if method not in indices:
+                for i, body in enumerate(method_bodies(method.set)):
+                    indices[body] = i
+            b_row.append(indices[method])
+        b.append(b_row)
+    return b
+
+def state_bits(num_states):
+    """
+    state_bits(int) -> int
+    
+    Get the number of low bits of a packed transition table entry that
+    hold the next state; see pack_trans_table.
+    """
+    return (num_states - 1).bit_length()
+
+def pack_trans_table(m, b, num_states):
+    """
+    pack_trans_table(matrix, matrix, int) -> matrix
+    
+    Pack the body index of each allowed transition into the table entry
+    above the bits of the next state, so that:
+    
+        next-state-id = entry & ((1 << state_bits) - 1)
+        body-index = entry >> state_bits
+    
+    Disallowed transitions stay -1. Methods with one body have body
+    index 0, so their entries are unchanged.
+    """
+    bits = state_bits(num_states)
+    packed = [ ]
+    for row, b_row in zip(m, b):
+        packed.append([
+            to_state >= 0 and to_state | (body << bits) or to_state
+            for to_state, body in zip(row, b_row)
+        ])
+    return packed
+
+def num_table_states(klass):
+    """
+    num_table_states(JavaType) -> int
+    
+    Get the number of states (rows) in the transition table that a state
+    class uses.
+    """
+    if options.split_tables:
+        return len(hierarchy_tables[hierarchy_ids[klass]])
+    return max(
+        offset + len(m) 
+        for offset, m in zip(hierarchy_offsets, hierarchy_tables)
+    )
+
+def trans_table_stride(m):
+    """
+    trans_table_stride(matrix) -> int
+    
+    Get the number of methods (columns) in a state transition table.
+    """
+    return len(m) and len(m[0]) or 0
+
+def is_matrix(values):
+    return len(values) and isinstance(values[0], list)
+
+def write_int_array(f, name, type, values, per_line=16):
+    """
+    write_int_array(file, string, string, list[, int]) -> void
+    
+    Write out the declaration of a static integer array (or matrix) of
+    the given element type in SM.java, initialized with its values.
+    """
+    if is_matrix(values):
+        f.write("\tfinal static public %s[][] %s = {\n" % (type, name))
+        sep = "\t\t"
+        for row in values:
+            f.write("%s{%s  }" % (sep, ",".join(("%3d" % j) for j in row)))
+            sep = ",\n\t\t"
+        f.write("\n\t};\n")
+        return
+    
+    f.write("\tfinal static public %s[] %s = {" % (type, name))
+    sep = "\n\t\t"
+    for i in range(0, len(values), per_line):
+        f.write(sep)
+        f.write(",".join(("%3d" % j) for j in values[i:i + per_line]))
+        sep = ",\n\t\t"
+    f.write("\n\t};\n")
+
+# struct formats and DataInputStream methods for reading each type of
+# array element from SM.bin
+resource_formats = {"byte": "b", "short": "h", "int": "i"}
+resource_readers = {"byte": "readByte", "short": "readShort", "int": "readInt"}
+
+def write_table_resource(f, arrays):
+    """
+    write_table_resource(file, list) -> void
+    
+    Write the arrays of the transition tables, a list of (name, type,
+    values) triples, to the binary resource that SM loads them from.
+    Each array is written as its length followed by its values, and
+    each matrix as its number of rows followed by its rows as arrays.
+    Lengths are 32-bit ints and values are of the array's type, all
+    big-endian as read by java.io.DataInputStream.
+    """
+    for _, type, values in arrays:
+        rows = is_matrix(values) and values or [values]
+        if rows is values:
+            f.write(struct.pack(">i", len(rows)))
+        for row in rows:
+            f.write(struct.pack(
+                ">i%d%s" % (len(row), resource_formats[type]), 
+                len(row), 
+                *row
+            ))
+
+def write_table_loader(f, arrays):
+    """
+    write_table_loader(file, list) -> void
+    
+    Write out the declarations of the arrays of the transition tables in
+    SM.java, along with a static initializer that loads them from the
+    binary resource SM.bin (see write_table_resource) when SM is first
+    used. This keeps the size of SM's static initializer independent of
+    the size of the tables.
+    """
+    readers = Set()
+    for name, type, values in arrays:
+        dims = is_matrix(values) and "[][]" or "[]"
+        f.write("\tfinal static public %s%s %s;\n" % (type, dims, name))
+        readers.add((type, dims))
+    
+    f.write("\tstatic {\n\t\ttry {\n")
+    f.write(
+        "\t\t\tjava.io.DataInputStream in = new java.io.DataInputStream(\n" +
+        "\t\t\t\tnew java.io.BufferedInputStream(\n" +
+        "\t\t\t\t\tSM.class.getResourceAsStream(\"SM.bin\")));\n"
+    )
+    for name, type, values in arrays:
+        f.write(
+            "\t\t\t%s = read%s%s(in);\n" 
+            % (name, type.title(), is_matrix(values) and "Matrix" or "Array")
+        )
+    f.write("\t\t\tin.close();\n")
+    f.write(
+        "\t\t} catch(java.io.IOException e) {\n" +
+        "\t\t\tthrow new ExceptionInInitializerError(e);\n" +
+        "\t\t}\n\t}\n"
+    )
+    
+    # one reader per type of array, e.g. readIntArray
+    for type in sorted(resource_readers):
+        if (type, "[]") in readers or (type, "[][]") in readers:
+            f.write(
+                ("\tstatic private %s[] read%sArray(java.io.DataInputStream " +
+                 "in)\n\t\tthrows java.io.IOException {\n" +
+                 "\t\t%s[] a = new %s[in.readInt()];\n" +
+                 "\t\tfor(int i = 0; i < a.length; ++i) {\n" +
+                 "\t\t\ta[i] = in.%s();\n" +
+                 "\t\t}\n\t\treturn a;\n\t}\n")
+                % (type, type.title(), type, type, resource_readers[type])
+            )
+        if (type, "[][]") in readers:
+            f.write(
+                ("\tstatic private %s[][] read%sMatrix(" +
+                 "java.io.DataInputStream in)\n" +
+                 "\t\tthrows java.io.IOException {\n" +
+                 "\t\t%s[][] m = new %s[in.readInt()][];\n" +
+                 "\t\tfor(int i = 0; i < m.length; ++i) {\n" +
+                 "\t\t\tm[i] = read%sArray(in);\n" +
+                 "\t\t}\n\t\treturn m;\n\t}\n")
+                % (type, type.title(), type, type, type.title())
+            )
+
+def trans_lookup_code(suffix, method_id, var, indent):
+    """
+    trans_lookup_code(string, string, string, string) -> string
+    
+    Get the Java code that declares the int variable var and sets it to
+    the entry of the transition table for the current state and the
+    method with the id given by the Java expression method_id, or to -1
+    if there is none. This depends on the table layout in SM.java; the
+    names of the table's arrays (and stride) end in suffix.
+    """
+    if options.table == "comb":
+        return (
+            "%sint __k = SM.base%s[this.__cs] + %s;\n" +
+            "%sint %s = SM.check%s[__k] == this.__cs ? SM.next%s[__k] : -1;\n"
+        ) % (indent, suffix, method_id, indent, var, suffix, suffix)
+    elif options.table == "flat":
+        return (
+            "%sint %s = SM.trans%s[this.__cs * SM.stride%s + %s];\n"
+            % (indent, var, suffix, suffix, method_id)
+        )
+    return "%sint %s = SM.trans%s[this.__cs][%s];\n" % (
+        indent, var, suffix, method_id
+    )
+
+def check_trans_code(klass):
+    """
+    check_trans_code(JavaType) -> string
+    
+    Get the Java code, for the body of __checkTrans in a root state
+    class, that looks up the next state of the current method
+    (method_id) in the transition table, stores it in __ns (and the
+    index of the body to run in __nb, with fused dispatch), and returns
+    whether the transition is allowed.
+    """
+    suffix = table_suffix(klass)
+    if options.fuse_dispatch:
+        bits = state_bits(num_table_states(klass))
+        return trans_lookup_code(suffix, "method_id", "__e", "\t\t\t") + (
+            "\t\t\tthis.__ns = %s(__e & %d);\n" +
+            "\t\t\tthis.__nb = __e >> %d;\n" +
+            "\t\t\treturn __e >= 0;\n"
+        ) % (state_cast(klass), (1 << bits) - 1, bits)
+    if options.table == "comb":
+        return (
+            "\t\t\tint __k = SM.base%s[this.__cs] + method_id;\n" +
+            "\t\t\tthis.__ns = SM.check%s[__k] == this.__cs ? " +
+            "SM.next%s[__k] : -1;\n" +
+            "\t\t\treturn this.__ns >= 0;\n"
+        ) % (suffix, suffix, suffix)
+    elif options.table == "flat":
+        return (
+            "\t\t\treturn (this.__ns = " +
+            "SM.trans%s[this.__cs * SM.stride%s + method_id]) >= 0;\n"
+        ) % (suffix, suffix)
+    return (
+        "\t\t\treturn (this.__ns = SM.trans%s[this.__cs][method_id]) >= 0;\n"
+        % suffix
+    )
+
+def write_trans_tables(f, arrays, strides, new_project_dir):
+    """
+    write_trans_tables(file, list, list, string) -> void
+    
+    Write the transition tables, a list of (name, type, values) triples,
+    and their strides, a list of (suffix, stride) pairs, to SM.java or
+    to its binary resource SM.bin.
+    """
+    if options.table == "flat":
+        for suffix, stride in strides:
+            f.write(
+                "\tfinal static public int stride%s = %d;\n" 
+                % (suffix, stride)
+            )
+    
+    if options.table_format == "binary":
+        resource = StringIO()
+        write_table_resource(resource, arrays)
+        count_output(write_if_changed(
+            "%s/SM.bin" % new_project_dir, resource.getvalue()
+        ))
+        write_table_loader(f, arrays)
+    else:
+        for name, type, values in arrays:
+            write_int_array(f, name, type, values)
 
 def compile_trans_class_file(package_name, new_project_dir):
     """
     compile_trans_class_file(string, string) -> Bool
     
-    Make the state transition class file, SM.java.
+    Make the state transition class file, SM.java, and the binary
+    resource SM.bin if the tables are written in binary. Files that
+    are already up to date are left alone; see write_if_changed. An
+    SM.bin left by an earlier build that is no longer used is removed.
     """
-    m = make_trans_table()
-    if not len(m):
+    global hierarchy_offsets, hierarchy_tables, hierarchy_bodies
+    resource = "%s/SM.bin" % new_project_dir
+    if os.path.exists(resource) and not (
+        hierarchy_classes and options.dispatch == "table" 
+        and options.table_format == "binary"
+    ):
+        os.remove(resource)
+    if not hierarchy_classes:
         return False
+    arrays = [ ]
+    strides = [ ]
+    
+    # one table per hierarchy, with its own local state ids
+    tables = hierarchy_tables = [ ]
+    hierarchy_bodies = [ ]
+    for h, local_state_ids in enumerate(hierarchy_state_ids):
+        m, bodies = make_trans_table(h)
+        b = body_index_table(bodies)
+        if options.minimize_states:
+            m, rows = minimize_trans_table(m, bodies)
+            for i in local_state_ids:
+                local_state_ids[i] = rows[local_state_ids[i]]
+            min_b = [None] * len(m)
+            for i, row in enumerate(b):
+                min_b[rows[i]] = row
+            b = min_b
+        tables.append(m)
+        hierarchy_bodies.append(b)
+    
+    names = dict((i, state) for state, i in state_ids.items())
+    def hierarchy_state_names(h):
+        return state_names(
+            (names[i], local_i) 
+            for i, local_i in hierarchy_state_ids[h].items()
+        )
+    
+    f = StringIO()
+    f.write("package %s;\n" % package_name)
+    f.write("final public class SM {\n")
     
-    with open("%s/SM.java" % (new_project_dir), "w") as f:
-        f.write("package %s;\n" % package_name)
-        f.write("final public class SM {\n")
+    # one state name table and transition table per hierarchy
+    if options.split_tables:
+        hierarchy_offsets = [0] * len(tables)
+        for h, m in enumerate(tables):
+            suffix = str(hierarchy_numbers[h])
+            f.write(
+                "\tfinal static public String[] states%s = {%s};\n" 
+                % (suffix, ", ".join(
+                    name is not None and "\"%s\"" % name or "null"
+                    for name in hierarchy_state_names(h)
+                ))
+            )
+            if options.fuse_dispatch:
+                m = pack_trans_table(m, hierarchy_bodies[h], len(m))
+            arrays.extend(trans_table_arrays(m, suffix))
+            strides.append((suffix, trans_table_stride(m)))
+        state_name = "state"
+    
+    else:
+        m = stack_trans_tables(tables)
         f.write(
             "\tfinal static public String[] states = new String[%s];\n" 
-            % len(state_ids)
+            % len(m)
         )
         
         # state name table
         f.write("\tstatic {\n")
-        for state, state_id in state_ids.items():
-            f.write("\t\tstates[%d] = \"%s\";\n" % (state_id, state))
+        for h, offset in enumerate(hierarchy_offsets):
+            for i, name in enumerate(hierarchy_state_names(h)):
+                if name is not None:
+                    f.write(
+                        "\t\tstates[%d] = \"%s\";\n" % (offset + i, name)
+                    )
         f.write("\t}\n")
         
-        # transition table
-        f.write("\tfinal static public int[][] trans = {\n")
-        sep = "\t\t"
-        for i in state_ids.values():
-            f.write("%s{%s  }" % (sep, ",".join(("%3d" % j) for j in m[i])))
-            sep = ",\n\t\t"
-        f.write("\n\t};\n")
-        
-        # error function
-        f.write("\tstatic public void error(String method, int state) {\n")
-        f.write(
-            "\t\tSystem.out.println(\"Error: cannot call method "+
-            "'\"+method+\"' from state '\"+states[state]+\"'.\");\n"
-        )
-        f.write("\t\tSystem.exit(1);\n")
-        f.write("\t}\n")
-        f.write("}\n")
+        if options.fuse_dispatch:
+            b = [[0] * trans_table_stride(m) for _ in m]
+            for body_rows, offset in zip(hierarchy_bodies, hierarchy_offsets):
+                for i, row in enumerate(body_rows):
+                    b[offset + i][:len(row)] = row
+            m = pack_trans_table(m, b, len(m))
+        arrays.extend(trans_table_arrays(m))
+        strides.append(("", trans_table_stride(m)))
+        state_name = "states[state]"
+    
+    # transition tables; with switch dispatch, the state classes have
+    # their columns inlined instead
+    if options.dispatch == "table":
+        write_trans_tables(f, arrays, strides, new_project_dir)
+    
+    # error function
+    f.write(
+        "\tstatic public void error(String method, %s state) {\n"
+        % (options.split_tables and "String" or "int")
+    )
+    f.write(
+        "\t\tSystem.out.println(\"Error: cannot call method "+
+        "'\"+method+\"' from state '\"+%s+\"'.\");\n" % state_name
+    )
+    f.write("\t\tSystem.exit(1);\n")
+    f.write("\t}\n")
+    f.write("}\n")
+    count_output(write_if_changed(
+        "%s/SM.java" % new_project_dir, f.getvalue()
+    ))
     return True
 
 def compile_state_method(klass, method_set, nf, old):
@@ -478,11 +1786,20 @@ def compile_state_method(klass, method_set, nf, old):
     set has many methods in it then those methods will be merged within
     the body of a switch statement.
     """
-    method = base_method = method_set.pop()
+    methods = method_bodies(method_set)
+    method = base_method = methods[0]
     nf.write("\t")
-    nf.write(old[method.header_span[0]:method.header_span[1]])
+    nf.write(span(old, method.header_span))
     nf.write(" {\n")
     
+    # in release mode, a method that can be called in any state and
+    # never changes it needs none of the state machinery. checked builds
+    # keep it, so that its body can't change the state unnoticed
+    if options.release and is_identity_set(klass, method_set):
+        nf.write(span(old, method.body_span, 1))
+        nf.write("\n\t}\n")
+        return
+    
     # method to generate the call to a parent method. this takes into
     # account the methods return type and deals with it accordingly.
     def call_parent_impl():
@@ -507,8 +1824,48 @@ def compile_state_method(klass, method_set, nf, old):
     
     # constructor, initialize the class to a state.
     if method.is_constructor:
-        for _, to_state in method.transitions():
-            nf.write("\t\tthis.__ns = %d;\n" % state_ids[to_state])
+        if not options.release:
+            for _, to_state in method.transitions():
+                nf.write("\t\tthis.__ns = %d;\n" % state_id(klass, to_state))
+        elif tracks_state(klass):
+            for _, to_state in method.transitions():
+                nf.write("\t\tthis.__cs = %d;\n" % state_id(klass, to_state))
+    
+    # unchecked state method; move to the next state up front, as there
+    # is no finally block to do it in
+    elif options.release:
+        if tracks_state(klass):
+            if options.dispatch == "switch":
+                nf.write(next_state_switch(klass, method))
+            else:
+                nf.write(next_state_lookup(klass, method))
+            
+            # the parent implementation handles the other states
+            if method_set.has_parent_impl:
+                nf.write("\t\tif(__next < 0) {\n")
+                nf.write(call_parent_impl())
+                nf.write("\t\t}\n")
+            if len(methods) > 1 and not options.fuse_dispatch:
+                nf.write("\t\tint __from = this.__cs;\n")
+            nf.write("\t\tthis.__cs = %s__next;\n" % state_cast(klass))
+    
+    # normal state method, with the next state found by a switch
+    elif options.dispatch == "switch":
+        nf.write(next_state_switch(klass, method))
+        nf.write("\t\tif(__next < 0) {\n")
+        
+        # the switch leaves __is alone when the call fails, so there is
+        # nothing to undo before deferring to the parent implementation
+        if method_set.has_parent_impl:
+            nf.write(call_parent_impl())
+        else:
+            nf.write(
+                "\t\t\tSM.error(\"%s::%s\", %s);\n" 
+                % (klass.name, method.name, error_state_code(klass))
+            )
+        
+        nf.write("\t\t}\n")
+        nf.write("\t\tthis.__is = true;\n\t\tthis.__ns = __next;\n")
     
     # normal state method
     else:
@@ -516,7 +1873,7 @@ def compile_state_method(klass, method_set, nf, old):
             nf.write("\t\tboolean __wis = this.__is;\n")
         
         nf.write(
-            "\t\tif(!this.__checkTrans(%d)) {\n" % method_ids[method]            
+            "\t\tif(!this.__checkTrans(%d)) {\n" % method_id(klass, method)
         )
         
         # defer check to parent class implementation. this mechanism
@@ -531,24 +1888,45 @@ def compile_state_method(klass, method_set, nf, old):
         # base case: no parent, error
         else:
             nf.write(
-                "\t\t\tSM.error(\"%s::%s\", this.__cs);\n" 
-                % (klass.name, method.name)
+                "\t\t\tSM.error(\"%s::%s\", %s);\n" 
+                % (klass.name, method.name, error_state_code(klass))
             )
         
         nf.write("\t\t}\n")
     
-    nf.write("\t\ttry {\n")
+    if not options.release:
+        nf.write("\t\ttry {\n")
     
     # the method set contains at least two methods, i.e. we need to merge the
     # bodies of many methods into one method.
-    if len(method_set):
-        method_set.add(method)
-        nf.write("\t\t\tswitch(this.__cs) {\n")
+    if len(methods) > 1:
+        if options.fuse_dispatch:
+            if options.release or options.dispatch == "switch":
+                nf.write("\t\t\tswitch(__body) {\n")
+            else:
+                nf.write("\t\t\tswitch(this.__nb) {\n")
+        else:
+            nf.write(
+                "\t\t\tswitch(%s) {\n" 
+                % (options.release and "__from" or "this.__cs")
+            )
         
-        for method in method_set:
+        for body, method in enumerate(methods):
             nf.write("\t\t\t\t")
-            for from_state, _ in method.transitions():
-                nf.write("case %d: " % state_ids[from_state])
+            
+            # with fused dispatch, the lookup of the next state found
+            # the index of the body too
+            if options.fuse_dispatch:
+                nf.write("case %d: " % body)
+            
+            # with minimized states, two from-states can have one id
+            else:
+                cases = [ ]
+                for from_state, _ in method.transitions():
+                    case = state_id(klass, from_state)
+                    if case not in cases:
+                        cases.append(case)
+                        nf.write("case %d: " % case)
             nf.write("{\n")
             
             # make sure that method parameter names are adjusted if the
@@ -556,23 +1934,182 @@ def compile_state_method(klass, method_set, nf, old):
             # types, of course)
             normalize_var_names(method.param_names, method.type_bounds)
             
-            nf.write(old[method.body_span[0]:method.body_span[1]][1:])
+            nf.write(span(old, method.body_span, 1))
             nf.write("\n\t\t\t\t\tbreak;")
             nf.write("\n\t\t\t\t}\n")
         nf.write("\t\t\t}\n")
     
     # life is easy, only one method to deal with
     else:
-        nf.write(old[method.body_span[0]:method.body_span[1]][1:])
+        nf.write(span(old, method.body_span, 1))
     
-    nf.write(
-        "\n\t\t} catch(Exception e) {\n\t\t\tSystem.out.println(e);" +
-        "\n\t\t\tSystem.exit(1);\n\t\t} finally {\n" +
-        "\t\t\tthis.__doTrans();\n\t\t}\n"
-    )
+    if options.release:
+        nf.write("\n")
+    else:
+        nf.write(
+            "\n\t\t} catch(Exception e) {\n\t\t\tSystem.out.println(e);" +
+            "\n\t\t\tSystem.exit(1);\n\t\t} finally {\n" +
+            "\t\t\tthis.__doTrans();\n\t\t}\n"
+        )
     
     nf.write("\t}\n")
 
+def is_identity_set(klass, method_set):
+    """
+    is_identity_set(JavaType, JavaMethodSet) -> Bool
+    
+    Check if a method set has one method that is allowed in every state
+    of its class hierarchy, never changes the state, and doesn't defer to
+    a parent implementation; e.g. a method without transitions, which is
+    given identity transitions in every state.
+    """
+    if len(method_set) != 1 or method_set.has_parent_impl:
+        return False
+    method = iter(method_set).next()
+    if method.is_constructor:
+        return False
+    h = hierarchy_ids[klass]
+    j = method_id(klass, method)
+    for i in Set(hierarchy_state_ids[h].values()):
+        if hierarchy_tables[h][i][j] != i:
+            return False
+    return True
+
+def next_state_switch(klass, method):
+    """
+    next_state_switch(JavaType, JavaMethod) -> string
+    
+    Get the Java code that sets the local variable __next to the state
+    that a call to a method of a state class moves to, or to -1 if the
+    method can't be called in the current state (or, unless in release
+    mode, during another state method). The method's column of the
+    transition table is inlined into a switch over the current state.
+    With fused dispatch, a method with several bodies also gets the
+    index of its body to run in __body.
+    """
+    h = hierarchy_ids[klass]
+    offset = hierarchy_offsets[h]
+    j = method_id(klass, method)
+    fused = options.fuse_dispatch and len(method.set) > 1
+    cases = { }
+    for i, row in enumerate(hierarchy_tables[h]):
+        if row[j] >= 0:
+            key = (row[j] + offset, fused and hierarchy_bodies[h][i][j])
+            cases.setdefault(key, [ ]).append(i + offset)
+    
+    code = ["\t\t%s __next = -1;\n" % state_field_type(klass)]
+    if fused:
+        code.append("\t\tint __body = -1;\n")
+    indent = "\t\t"
+    if not options.release:
+        code.append("\t\tif(!this.__is) {\n")
+        indent = "\t\t\t"
+    code.append("%sswitch(this.__cs) {\n" % indent)
+    for (to_state, body), from_states in sorted(cases.items()):
+        code.append("%s\t" % indent)
+        code.extend("case %d: " % i for i in from_states)
+        code.append("__next = %d; " % to_state)
+        if fused:
+            code.append("__body = %d; " % body)
+        code.append("break;\n")
+    code.append("%s}\n" % indent)
+    if not options.release:
+        code.append("\t\t}\n")
+    return "".join(code)
+
+def next_state_lookup(klass, method):
+    """
+    next_state_lookup(JavaType, JavaMethod) -> string
+    
+    Get the Java code that sets the local variable __next to the state
+    that a call to a method of a state class moves to, or to -1 if the
+    method can't be called in the current state, by looking it up in
+    the transition table. This is __checkTrans without the checks, for
+    release mode. With fused dispatch, a method with several bodies also
+    gets the index of its body to run in __body.
+    """
+    code = trans_lookup_code(
+        table_suffix(klass), str(method_id(klass, method)), "__next", "\t\t"
+    )
+    if options.fuse_dispatch and len(method.set) > 1:
+        bits = state_bits(num_table_states(klass))
+        code += (
+            "\t\tint __body = __next >> %d;\n" +
+            "\t\tif(__next >= 0) {\n\t\t\t__next &= %d;\n\t\t}\n"
+        ) % (bits, (1 << bits) - 1)
+    return code
+
+def find_tracked_hierarchies():
+    """
+    find_tracked_hierarchies(void) -> Set
+    
+    Find the hierarchies whose instances need to keep track of their
+    current state in release mode: those with a method that either has
+    several bodies, one for each of its from-states, or that defers to
+    its parent implementation in some states.
+    """
+    tracked = Set()
+    for h, members in enumerate(hierarchy_classes):
+        for member in members:
+            for method_set in member.method_sets():
+                if len(method_set) > 1 or method_set.has_parent_impl:
+                    tracked.add(h)
+    return tracked
+
+def tracks_state(klass):
+    """
+    tracks_state(JavaType) -> Bool
+    
+    Check if instances of a state class keep track of their current
+    state. They always do, except in release mode; see
+    find_tracked_hierarchies.
+    """
+    return not options.release or hierarchy_ids[klass] in tracked_hierarchies
+
+def state_field_type(klass):
+    """
+    state_field_type(JavaType) -> string
+    
+    Get the Java type of the __cs and __ns fields of a state class. This
+    is the narrowest type that fits the states of the class's transition
+    table in the flat layout, and int otherwise.
+    """
+    if options.table != "flat":
+        return "int"
+    return state_type(num_table_states(klass))
+
+def state_cast(klass):
+    """
+    state_cast(JavaType) -> string
+    
+    Get the cast, if any, needed to store an int in the __cs and __ns
+    fields of a state class.
+    """
+    if state_field_type(klass) == "int":
+        return ""
+    return "(%s) " % state_field_type(klass)
+
+def error_state_code(klass):
+    """
+    error_state_code(JavaType) -> string
+    
+    Get the Java code for the argument to SM.error that identifies the
+    current state of an instance of a state class.
+    """
+    if not options.split_tables:
+        return "this.__cs"
+    return "SM.states%s[this.__cs]" % table_suffix(klass)
+
+def span(old, (start, end), skip=0):
+    """
+    span(string, (int, int)[, int]) -> buffer
+    
+    Get a read-only view of a span of the source code of a class, less
+    the first skip characters, without copying it.
+    """
+    start += skip
+    return buffer(old, start, max(end - start, 0))
+
 def compile_non_state_method(header_span, body_span, nf, old):
     """
     compile_non_state_method((int, int), (int, int), file, string)
@@ -580,41 +2117,49 @@ def compile_non_state_method(header_span, body_span, nf, old):
     Copy a non-state method into the class.
     """
     nf.write("\t")
-    nf.write(old[header_span[0]:header_span[1]])
+    nf.write(span(old, header_span))
     nf.write(" {\n")
     #nf.write("\t\tif(this.__is) {\n\t\t\tSystem.exit(1);\n\t\t}\n")
-    nf.write(old[body_span[0]:body_span[1]][1:])
+    nf.write(span(old, body_span, 1))
     nf.write("\n\t}\n")
 
-def compile_class_file(klass, package_name, of, nf):
+def compile_class_file(klass, package_name, nf):
     """
-    compile_class_file(JavaType, string, file, file)
+    compile_class_file(JavaType, string, file)
     
-    Compile a single class file.
+    Compile a single class file from the source code that it was parsed
+    from.
     """
-    old = of.read()
+    old = klass.source
     
     # import statements
     if klass.import_span:
-        nf.write(old[klass.import_span[0]:klass.import_span[1]])
+        nf.write(span(old, klass.import_span))
         nf.write("\n")
     nf.write("import %s.SM;\n" % package_name)
     
-    nf.write(old[klass.header_span[0]:klass.header_span[1]])
+    nf.write(span(old, klass.header_span))
     nf.write("{\n")
     
     # previous and current state parameters. __is is defaulted to true as that
     # will be the case when the constructor is called.
-    if not len(klass.parents):
-        nf.write("\tprotected int __cs, __ns;\n")
+    if not len(klass.parents) and options.release:
+        if tracks_state(klass):
+            nf.write("\tprotected %s __cs;\n" % state_field_type(klass))
+    
+    elif not len(klass.parents):
+        nf.write("\tprotected %s __cs, __ns;\n" % state_field_type(klass))
         nf.write("\tprotected boolean __is = true;\n")
+        if options.fuse_dispatch and options.dispatch == "table":
+            nf.write("\tprotected int __nb;\n")
         
         # checkTrans method, returns false to not allow calls to transitioning
         # methods when already transitioning
-        nf.write("\tprotected boolean __checkTrans(int method_id) {\n")
-        nf.write("\t\tif(!this.__is) {\n\t\t\tthis.__is = true;\n")
-        nf.write("\t\t\treturn (this.__ns = SM.trans[this.__cs][method_id]) >= 0;\n")
-        nf.write("\t\t}\n\t\treturn false;\n\t}\n")
+        if options.dispatch == "table":
+            nf.write("\tprotected boolean __checkTrans(int method_id) {\n")
+            nf.write("\t\tif(!this.__is) {\n\t\t\tthis.__is = true;\n")
+            nf.write(check_trans_code(klass))
+            nf.write("\t\t}\n\t\treturn false;\n\t}\n")
         
         # doTrans method
         nf.write("\tprotected void __doTrans() {\n")
@@ -624,8 +2169,10 @@ def compile_class_file(klass, package_name, of, nf):
         nf.write("\t\t}\n\t}\n")
     
     # params
-    for name, (start_param, end_param) in klass.params.values():
-        nf.write(old[start_param:end_param])
+    for name, param_span in sorted(
+        klass.params.values(), key=lambda param: param[1]
+    ):
+        nf.write(span(old, param_span))
         nf.write("\n")
     
     # state transitioning methods
@@ -638,6 +2185,121 @@ def compile_class_file(klass, package_name, of, nf):
     
     nf.write("}\n")
 
+def write_if_changed(file_name, data):
+    """
+    write_if_changed(string, string) -> Bool
+    
+    Write data to a file unless the file already holds exactly that
+    data, so that the modification times of up-to-date output files
+    don't change. Returns True if the file was written.
+    
+    The data goes into a new file that replaces the old one, so that
+    writing can never go through a hard link from an earlier build into
+    its source (see place_copy).
+    """
+    try:
+        if os.path.getsize(file_name) == len(data):
+            with open(file_name, "rb") as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+    temp = "%s.%d.tmp" % (file_name, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(data)
+    if os.path.lexists(file_name):
+        os.remove(file_name)
+    os.rename(temp, file_name)
+    return True
+
+def copy_if_changed(src, dst):
+    """
+    copy_if_changed(string, string) -> Bool
+    
+    Copy a file unless the copy already has the same contents (or is a
+    link to it); see write_if_changed and place_copy. Returns True if
+    the file was copied.
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return False
+        if filecmp.cmp(src, dst, shallow=False):
+            return False
+    except OSError:
+        pass
+    place_copy(src, dst)
+    return True
+
+def reflink_file(src, dst):
+    """
+    reflink_file(string, string) -> void
+    
+    Make dst a copy of src that shares its data blocks.
+    """
+    if not fcntl:
+        raise OSError("reflinks are not supported")
+    with open(src, "rb") as src_file:
+        with open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+copy_functions = {
+    "link": os.link,
+    "reflink": reflink_file,
+    "copy": shutil.copyfile,
+}
+
+def place_copy(src, dst):
+    """
+    place_copy(string, string) -> void
+    
+    Make dst a copy of src using the best of the copy methods that the
+    filesystem supports: a hard link, then a reflink, then a plain copy.
+    A method that fails is not tried again.
+    
+    The old dst is removed first, so that writing a new copy can never
+    write through a hard link from an earlier build into its source.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for method in list(copy_methods):
+        try:
+            copy_functions[method](src, dst)
+            return
+        except (OSError, IOError):
+            if method == "copy":
+                raise
+            try:
+                copy_methods.remove(method)
+            except ValueError:
+                pass # already dropped by another thread
+            if os.path.lexists(dst):
+                os.remove(dst)
+
+def count_output(written):
+    """
+    count_output(Bool) -> void
+    
+    Count an output file as written or as unchanged. This is only called
+    from the main thread.
+    """
+    output_counts[not written] += 1
+
+def output_class(args):
+    """
+    output_class((JavaType, string, string, Bool)) -> Bool
+    
+    Write the new file of a class: its compiled code if it is a state
+    class and states are used, and a copy of it otherwise. This only
+    reads the compiler's state, so it can run in a worker thread.
+    Returns True if the file was written.
+    """
+    klass, package_name, new_file, use_states = args
+    if not use_states or not len(klass.states):
+        return copy_if_changed(klass.file, new_file)
+    nf = StringIO()
+    compile_class_file(klass, package_name, nf)
+    return write_if_changed(new_file, nf.getvalue())
+
 def compile_classes():
     """
     compile_classes(void) -> void
@@ -645,9 +2307,19 @@ def compile_classes():
     Compile a State Java project into a Java project.
     """
     
-    # make the set of method sets
+    global output_counts, copy_methods, tracked_hierarchies
+    output_counts = [0, 0]
+    if options.copy_method == "link":
+        copy_methods = ["link", "reflink", "copy"]
+    else:
+        copy_methods = ["copy"]
+    
+    # number the states and method sets of each hierarchy
+    make_hierarchies()
     for method in state_methods():
-        method_ids[method] = method.set.id()
+        method_ids[method] = method.set.id
+    if options.release:
+        tracked_hierarchies = find_tracked_hierarchies()
     
     # resolve and make our new project directory
     package_name = os.path.basename(project_dir)
@@ -660,7 +2332,10 @@ def compile_classes():
     # make the main state machine class that will allow for simple
     # state inheritence
     use_states = compile_trans_class_file(package_name, new_project_dir)
+    if options.id_map:
+        save_id_map(options.id_map)
     
+    jobs = [ ]
     for klass in type_list:
         
         # figure out our new file name and create the directory
@@ -671,24 +2346,236 @@ def compile_classes():
         new_dir = os.path.dirname(new_file)
         if not os.path.isdir(new_dir):
             os.makedirs(new_dir)
-        
-        if not use_states or not len(klass.states):
-            shutil.copyfile(klass.file, new_file)
-        else:
-            with open(klass.file, "r") as old_file:
-                with open(new_file, "w") as new_file:
-                    compile_class_file(
-                        klass, 
-                        package_name, 
-                        old_file, 
-                        new_file
-                    )
-
+        jobs.append((klass, package_name, new_file, use_states))
+    
+    # each class goes to its own file, so the output is the same no
+    # matter which thread writes which class
+    if options.codegen_jobs > 1 and len(jobs) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(options.codegen_jobs, len(jobs)))
+        try:
+            results = pool.map(
+                output_class, 
+                jobs, 
+                len(jobs) // (options.codegen_jobs * 4) + 1
+            )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [output_class(args) for args in jobs]
+    
+    for written in results:
+        count_output(written)
+    
+    print "Output files: %d written, %d unchanged." % tuple(output_counts)
     return new_project_dir
 
-def test_compiler():
+def build_test_project(project_dir, files, args=()):
+    """
+    build_test_project(string, dict[, list]) -> void
+    
+    Write the given source files (name -> contents) into a project
+    directory, and compile the project with the given command line
+    options. Existing files are rewritten in place, and files with None
+    as their contents are removed.
+    """
+    if not os.path.isdir(project_dir):
+        os.makedirs(project_dir)
+    for name, source in files.items():
+        if source is None:
+            os.remove(os.path.join(project_dir, name))
+            continue
+        with open(os.path.join(project_dir, name), "wb") as f:
+            f.write(source)
+    compile_project(project_dir, make_option_parser().parse_args(
+        list(args)
+    )[0])
+
+def test_link_rebuild():
+    """
+    test_link_rebuild(void) -> void
+    
+    Check that when a class that was hard linked into the new project
+    starts to use states, rebuilding the project replaces the link
+    instead of writing the compiled class into its source.
+    """
+    plain = "package Link;\n\nclass Foo {\n    public Foo() { }\n}\n"
+    stateful = (
+        "package Link;\n\nclass Foo {\n    states { :A, :B }\n"
+        "    public Foo() :A { }\n    public void bar() :A -> :B { }\n}\n"
+    )
+    temp_dir = tempfile.mkdtemp()
+    try:
+        project_dir = os.path.join(temp_dir, "Link")
+        build_test_project(
+            project_dir, {"Foo.java": plain}, ("--copy-method", "link")
+        )
+        build_test_project(
+            project_dir, {"Foo.java": stateful}, ("--copy-method", "link")
+        )
+        with open(os.path.join(project_dir, "Foo.java"), "rb") as f:
+            if f.read() != stateful:
+                sys.stderr.write("Test Error: source was overwritten\n")
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_id_map_rebuild():
+    """
+    test_id_map_rebuild(void) -> void
+    
+    Check that with an id map, adding a state to one class leaves the
+    compiled code of the classes that don't change unchanged: those of
+    other hierarchies, and with split tables, those of its own. Likewise
+    for removing a hierarchy, which must not renumber the ones after it.
+    """
+    bar = (
+        "package Ids;\n\nclass Bar {\n    states { :C, :D }\n"
+        "    public Bar() :C { }\n    public void go() :C -> :D { }\n}\n"
+    )
+    base = (
+        "package Ids;\n\nclass Base {\n    states { :X, :Y }\n"
+        "    public Base() :X { }\n    public void go() :X -> :Y { }\n}\n"
+    )
+    foo = (
+        "package Ids;\n\nclass Foo extends Base {\n%s"
+        "    public Foo() :X { }\n%s}\n"
+    )
+    qux = (
+        "package Ids;\n\nclass Qux {\n    states { :P, :Q }\n"
+        "    public Qux() :P { }\n    public void go() :P -> :Q { }\n}\n"
+    )
+    new_foo = foo % (
+        "    states { :C }\n", "    public void back() :Y -> :C { }\n"
+    )
+    removed = {"Base.java": None, "Foo.java": None}
+    tests = (
+        ((), {"Foo.java": new_foo}, ("Bar.java", "Qux.java")),
+        (("--split-tables", ), {"Foo.java": new_foo},
+         ("Bar.java", "Base.java", "Qux.java")),
+        ((), removed, ("Bar.java", "Qux.java")),
+        (("--split-tables", ), removed, ("Bar.java", "Qux.java")),
+    )
+    for args, changes, names in tests:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            project_dir = os.path.join(temp_dir, "Ids")
+            new_dir = os.path.join(temp_dir, "S", "Ids")
+            args += ("--id-map", os.path.join(temp_dir, "ids.txt"))
+            build_test_project(project_dir, {
+                "Bar.java": bar, "Base.java": base,
+                "Foo.java": foo % ("", ""), "Qux.java": qux
+            }, args)
+            old = { }
+            for name in names:
+                with open(os.path.join(new_dir, name), "rb") as f:
+                    old[name] = f.read()
+            build_test_project(project_dir, changes, args)
+            for name in names:
+                with open(os.path.join(new_dir, name), "rb") as f:
+                    if f.read() != old[name]:
+                        sys.stderr.write("Test Error: %s changed\n" % name)
+        finally:
+            shutil.rmtree(temp_dir)
+
+def test_identity_checks():
     """
-    test_compiler(void) -> void
+    test_identity_checks(void) -> void
+    
+    Check that a method with identity transitions in every state keeps
+    its state checks in a checked build, so that a transition made from
+    its body is still reported, and loses them in release mode.
+    """
+    foo = (
+        "package Ident;\n\nclass Foo {\n    states { :A, :B }\n"
+        "    public Foo() :A { }\n    public void go() :A -> :B { }\n"
+        "    public int get() { this.go(); return 1; }\n}\n"
+    )
+    temp_dir = tempfile.mkdtemp()
+    try:
+        project_dir = os.path.join(temp_dir, "Ident")
+        new_file = os.path.join(temp_dir, "S", "Ident", "Foo.java")
+        for args, checked in (((), True), (("--release", ), False)):
+            build_test_project(project_dir, {"Foo.java": foo}, args)
+            with open(new_file, "rb") as f:
+                code = f.read()
+            start = code.index("public int get() {")
+            code = code[start:code.index("\n\t}\n", start)]
+            if ("__checkTrans" in code and "SM.error" in code) != checked:
+                sys.stderr.write(
+                    "Test Error: state checks of Foo::get %s\n"
+                    % (checked and "missing" or "left in release mode")
+                )
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_minimize_trans_table():
+    """
+    test_minimize_trans_table(void) -> void
+    
+    Check that minimize_trans_table merges the states of a table that
+    cannot be told apart, and that every transition of the minimized
+    table matches the original one.
+    """
+    # states 1 and 2 only differ in name, and so do 3 and 4
+    m = [
+        [1, 2, -1],
+        [3, -1, 0],
+        [4, -1, 0],
+        [-1, -1, 0],
+        [-1, -1, 0],
+    ]
+    bodies = [
+        [to_state >= 0 and "m%d" % j or None
+         for j, to_state in enumerate(row)]
+        for row in m
+    ]
+    min_m, rows = minimize_trans_table(m, bodies)
+    if len(min_m) != 3:
+        sys.stderr.write(
+            "Test Error: %d states after minimizing, not 3\n" % len(min_m)
+        )
+    for i, row in enumerate(m):
+        for j, to_state in enumerate(row):
+            if to_state >= 0:
+                to_state = rows[to_state]
+            if min_m[rows[i]][j] != to_state:
+                sys.stderr.write(
+                    "Test Error: minimized transition (%d, %d) is wrong\n"
+                    % (i, j)
+                )
+
+def test_compress_trans_table():
+    """
+    test_compress_trans_table(void) -> void
+    
+    Check that every entry of some transition tables, including their
+    empty entries and rows, decodes back from their comb compression.
+    """
+    tables = (
+        [[1, -1, 2], [-1, -1, -1], [0, 1, 2], [-1, 2, -1]],
+        [[-1, -1], [1, 0], [-1, -1]],
+        [[0, 0, 0, 0], [1, 1, 1, 1]],
+        [[-1]],
+    )
+    for m in tables:
+        try:
+            base, next, check = compress_trans_table(m)
+        except AssertionError, e:
+            sys.stderr.write("Test Error: %s\n" % e)
+            continue
+        for i, row in enumerate(m):
+            for j, to_state in enumerate(row):
+                if base[i] + j >= len(check) or \
+                        comb_lookup(base, next, check, i, j) != to_state:
+                    sys.stderr.write(
+                        "Test Error: comb table entry (%d, %d) of %r is "
+                        "wrong\n" % (i, j, m)
+                    )
+
+def test_compiler(opts=None):
+    """
+    test_compiler([optparse.Values]) -> void
     
     Run the compiler through the basic failure test cases. Each test should
     result in either a failure or a warning.
@@ -714,12 +2601,22 @@ def test_compiler():
         print "\n-------------------------------------------"
         print "Testing: %s" % test
         print "-------------------------------------------\n"
-        compile_project(test)
+        compile_project(test, opts)
+    tests = (
+        test_link_rebuild, test_id_map_rebuild, test_identity_checks,
+        test_minimize_trans_table, test_compress_trans_table,
+    )
+    for test in tests:
+        print "\n-------------------------------------------"
+        print "Testing: %s" % test.__name__
+        print "-------------------------------------------\n"
+        test()
     print "\n-------------------------------------------"
     print "Done testing."
 
 if __name__ == "__main__":
-    if len(sys.argv) >= 2:
-        compile_project(sys.argv[1])
+    opts, args = make_option_parser().parse_args()
+    if len(args) >= 1:
+        compile_project(args[0], opts)
     else:
-        test_compiler()
+        test_compiler(opts)
@@ -19,26 +19,21 @@ class JavaMethodSet(Set):
     sets of starting transition states.
     """
     
-    id_count = 0
-    
     def __init__(self):
         Set.__init__(self)
         self._all_from_states = None
         self.has_parent_impl = False
-        self._id = None
+        self.id = None # numbered per hierarchy by the compiler
     
-    def id(self):
-        """
-        id(void) -> int
-
-        Get this ID of this method. This is put into a function so that
-        we don't assign ids to all method instances when they might not
-        be used in state classes.
-        """
-        if not self._id:
-            self._id = JavaMethodSet.id_count
-            JavaMethodSet.id_count += 1
-        return self._id
+    def __getstate__(self):
+        # Set only pickles its elements; keep our own attributes too so
+        # that method sets survive the parse cache.
+        return Set.__getstate__(self), self.__dict__
+    
+    def __setstate__(self, state):
+        data, attrs = state
+        Set.__setstate__(self, data)
+        self.__dict__.update(attrs)
     
     def add(self, method):
         """
@@ -12,7 +12,7 @@
 
 from sets import Set
 from error import *
-from java_method import JavaMethodSet
+from java_method import JavaMethod, JavaMethodSet
 
 class JavaType(object):
     """
@@ -56,11 +56,37 @@ class JavaType(object):
         self.parents = Set()
         
         self.is_interface = False
+        self.is_header_only = False # only the imports and header parsed
         self.header_span = None # bounds for the header of the class
         self.import_span = None # bounds for the imports / package
         
+        self.package = None # name of the package
+        self.imports = [ ] # imported names, e.g. "a.b.C" or "a.b.*"
+        
+        # source code of the class file, which all of the spans index
+        # into. this is kept for code generation but is not pickled.
+        self.source = None
+        
+        self.id = JavaType.id
+        JavaType.id += 1
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["source"] = None
+        return state
+    
+    def register(self):
+        """
+        register(void) -> void
+        
+        Give a type that was not built by the parser in this process
+        (e.g. one loaded from the parse cache) a fresh id, and add its
+        methods to the set of all methods.
+        """
         self.id = JavaType.id
         JavaType.id += 1
+        for method in self.methods():
+            JavaMethod.methods.add(method)
     
     def add_param(self, name, header):
         """
@@ -182,10 +208,11 @@ class JavaType(object):
         """
         method_sets(void) -> Generator<JavaMethodSet>
         
-        Generate this type's method sets.
+        Generate this type's method sets, ordered by method name and
+        signature.
         """
-        for method_sigs in self.state_methods.values():
-            for method_set in method_sigs.values():
+        for _, method_sigs in sorted(self.state_methods.items()):
+            for _, method_set in sorted(method_sigs.items()):
                 yield method_set
     
     def methods(self):
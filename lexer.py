@@ -79,8 +79,8 @@ tokens = (
 
 # lexemes
 t_STATE         = r':[a-zA-Z0-9_]+'
-t_LT            = r'\<'
-t_GT            = r'\>'
+t_LT            = r'<'
+t_GT            = r'>'
 t_LBRACE        = r'\{'
 t_RBRACE        = r'\}'
 t_LPAREN        = r'\('
@@ -112,15 +112,13 @@ def t_ID(t):
     t.type = reserved.get(t.value, 'ID')
     return t
 
-# ignored chars
-t_ignore_WHITE_SPACE = r"[ \t\r]+"
+# ignored chars. newlines are ignored too; line numbers are found from
+# token offsets when they are needed (see TokenArray.line).
+t_ignore_WHITE_SPACE = r"[ \t\r\n]+"
 t_ignore_COMMENT = r'/\*(.|\n)*?\*/'
+t_ignore_LINE_COMMENT = r'//[^\n]*'
 
 # special
-def t_newline(t):
-    r'\n+'
-    t.lexer.lineno += len(t.value)
-
 def t_error(t):
     print "Scanner Error: illegal character '%s'." % t.value[0]
     t.lexer.skip(1)
@@ -0,0 +1,108 @@
+# ----------------------------------------------------------------------
+# StateJava: parse_cache.py
+#
+# Copyright (C) 2009, 
+# Peter Goodman,
+# All rights reserved.
+#
+# On-disk cache of parsed Java types. Entries are keyed by the path of
+# the parsed file and a hash of its contents so that only files that
+# have changed since the last compile need to be parsed again.
+#
+# ----------------------------------------------------------------------
+
+from __future__ import with_statement
+import os, cPickle, hashlib
+
+# modules whose source determines the shape of a parsed JavaType; if
+# any of them change then every cache entry is stale.
+parser_modules = (
+    "lexer.py", "scanner.py", "token_array.py", "parser.py",
+    "java_type.py", "java_method.py",
+)
+
+class ParseCache(object):
+    """
+    A directory of pickled JavaType instances, one entry per parsed
+    file. Each entry records the hash of the contents that the type was
+    parsed from, and is only used if the file still hashes the same.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        ParseCache(string)
+
+        Open (or create) the parse cache in cache_dir.
+        """
+        self.dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+        # hash of the parser itself; part of every entry's key
+        h = hashlib.md5()
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        for module in parser_modules:
+            with open(os.path.join(base_dir, module), "rb") as f:
+                h.update(f.read())
+        self.parser_hash = h.hexdigest()
+
+    def entry_path(self, file_path):
+        """
+        entry_path(string) -> string
+
+        Get the path of the cache entry for a Java file.
+        """
+        return os.path.join(
+            self.dir,
+            "%s.pickle" % hashlib.md5(file_path).hexdigest()
+        )
+
+    def key(self, file_path, source):
+        """
+        key(string, string) -> tuple
+
+        Get the key that an entry for a file with the given contents must
+        have in order to be used.
+        """
+        return (self.parser_hash, file_path, hashlib.md5(source).hexdigest())
+
+    def load(self, file_path, source):
+        """
+        load(string, string) -> JavaType | None
+
+        Load the type parsed from file_path, if it was cached when the
+        file had the contents source. Types returned by this need to be
+        registered before they are used.
+        """
+        try:
+            with open(self.entry_path(file_path), "rb") as f:
+                key, klass = cPickle.load(f)
+        except Exception:
+            # missing or unreadable entries are simply cache misses
+            return None
+
+        if key != self.key(file_path, source):
+            return None
+        return klass
+
+    def store(self, file_path, source, klass):
+        """
+        store(string, string, JavaType) -> void
+
+        Cache the type parsed from file_path. This must be called before
+        type checking starts modifying the type.
+        """
+        entry = self.entry_path(file_path)
+        temp = "%s.%d.tmp" % (entry, os.getpid())
+        try:
+            with open(temp, "wb") as f:
+                cPickle.dump(
+                    (self.key(file_path, source), klass),
+                    f,
+                    cPickle.HIGHEST_PROTOCOL
+                )
+            if os.path.exists(entry):
+                os.remove(entry)
+            os.rename(temp, entry)
+        except (IOError, OSError):
+            pass # the cache is only an optimization
@@ -17,16 +17,16 @@ from ply import lex
 from sets import Set
 from java_type import JavaType
 from java_method import JavaMethod
-import lexer, sys
+from token_array import TokenArray, PlyScanner, token_names
+from token_array import skip_block, skip_statement
+from scanner import Scanner
+import lexer, sys, os, imp
 
 # ----------------------------------------------------------------------
 
-look_ahead = [ ]
-generic_klass_types = None
-java_lexer = lex.lex(module=lexer)
-curr_lexer = None
-klass = None
-seen_klass_states = False
+java_lexer = None        # master lexer; built on first use
+optimize_lexer = False   # build java_lexer from the cached lextab
+scanner_backend = "ply"  # "ply" for java_lexer or "fast" for Scanner
 inherited_modifiers = ("public", "protected", )
 stateful_modifiers = ("public", )
 
@@ -40,83 +40,81 @@ class ParseError(Exception):
 
 # ----------------------------------------------------------------------
 
-def parse_file(file_path):
-    global look_ahead, java_lexer, curr_lexer, klass, klass_id
-    global seen_klass_states
+def get_lexer():
+    """
+    get_lexer(void) -> Lexer
     
-    del look_ahead[:]
+    Get the master lexer, building it if this is the first time that it
+    is needed. Parsers use clones of this lexer.
     
-    curr_lexer = java_lexer.clone()
-    klass = JavaType(file_path)
+    If optimize_lexer is set then the lexer is built from lextab.py, a
+    table file written by PLY next to lexer.py. This skips PLY's checks
+    of the rules in lexer.py. The table is (re)written whenever it is
+    missing or older than lexer.py.
+    """
+    global java_lexer
+    if java_lexer:
+        return java_lexer
+    
+    if not optimize_lexer:
+        java_lexer = lex.lex(module=lexer)
+        return java_lexer
+    
+    tab_dir = os.path.dirname(os.path.abspath(lexer.__file__))
+    tab_file = os.path.join(tab_dir, "lextab.py")
+    rules_file = os.path.join(tab_dir, "lexer.py")
+    
+    if (os.path.exists(tab_file) and 
+        os.path.getmtime(tab_file) >= os.path.getmtime(rules_file)):
+        try:
+            java_lexer = lex.lex(
+                module=lexer, 
+                optimize=1, 
+                lextab=imp.load_source("lextab", tab_file)
+            )
+            return java_lexer
+        except (ImportError, SyntaxError):
+            pass
     
+    java_lexer = lex.lex(module=lexer)
     try:
-        with open(file_path) as f:
-            curr_lexer.input(f.read())
-            seen_klass_states = False
-            parse_class_file()
-            print "Parsed file:", file_path
-    except ParseError, e:
-        sys.stderr.write("Parse Error: %s \n" % e)
-        return None
-    except NoTokensLeftException, e:
-        sys.stderr.write(
-            "Parse Error: Unexpected end of input in file %s. \n"
-            % klass.file
-        )
-        return None
-    return klass
-
-# ----------------------------------------------------------------------
+        java_lexer.writetab("lextab", tab_dir)
+    except IOError:
+        pass # can't cache the tables; they will be rebuilt next time
+    return java_lexer
 
-def get_token():
-    global look_ahead, curr_lexer
-    if len(look_ahead):
-        tok = look_ahead.pop()
-    else:
-        tok = curr_lexer.token()
-        if not tok:
-            raise NoTokensLeftException()
+def make_scanner():
+    """
+    make_scanner(void) -> PlyScanner | Scanner
     
-    return tok
-
-def peek_token():
-    tok = get_token()
-    pushback_token(tok)
-    return tok
-
-def pushback_token(tok):
-    global look_ahead
-    look_ahead.append(tok)
-
-def accept(*types):
-    tok = get_token()
-    if len(types) and tok.type not in types:
-        raise ParseError(
-            ("Unexpected token '%s' of type '%s', expected type of " +
-             "%s in %s:%d")
-            % (tok.value, tok.type, types, klass.file, tok.lineno)
-        )
-    return tok
+    Make a new scanner for a file, using the backend selected by 
+    scanner_backend. Both backends produce the same tokens.
+    """
+    if scanner_backend == "fast":
+        return Scanner()
+    return PlyScanner(get_lexer().clone())
 
-def maybe(*types):
-    tok = get_token()
-    if tok.type not in types:
-        pushback_token(tok)
-        return False
-    return tok
+def parse_file(file_path, source=None):
+    """
+    parse_file(string[, string]) -> JavaType | None
+    
+    Parse a single Java file using a new parser. See Parser.parse_file.
+    """
+    return Parser().parse_file(file_path, source)
 
-def peek(*types):
-    tok = peek_token()
-    if not len(types) or tok.type in types:
-        return tok
-    return False
+def scan_file(file_path, source=None):
+    """
+    scan_file(string[, string]) -> JavaType | None
     
+    Parse only the imports and the class header of a single Java file
+    using a new parser. See Parser.parse_file.
+    """
+    return Parser().parse_file(file_path, source, True)
+
 def repeat(predicate):
     while predicate():
         pass
 
-# ----------------------------------------------------------------------
-
 def erase_types(parts, fmt):
     """
     erase_types(list, string) -> dict
@@ -141,390 +139,530 @@ def erase_types(parts, fmt):
     
     return erased_types
 
-def erased_type(type_name, inferred_method_types):
-    """
-    erased_type(string, {}) -> string
-
-    Return the erased type for type_name.
-    """
-    global generic_klass_types
-
-    # look at the non-array portion
-    if type_name in generic_klass_types:
-        return generic_klass_types[type_name]
-    elif type_name in inferred_method_types:
-        return inferred_method_types[type_name]
-
-    return type_name
-
 # ----------------------------------------------------------------------
 
-def parse_class_file():
+class Parser(object):
     """
-    parse_class_file(void) -> void
-    
-    Parse a Java class file. A class file can contain a series of
-    imports followed by either a class or interface definition.
+    A parser for a single StateJava file at a time. All parse state is
+    kept in the parser instance, so distinct parsers can be used at the
+    same time (e.g. from different threads).
+    
+    The file is lexed into a TokenArray and the parser walks it with an
+    integer cursor. Tokens are passed around by their index into the
+    array, so looking ahead and backing up is only a matter of moving
+    the cursor. Method bodies and field initializers are skipped over
+    by scanning the source, without being lexed.
     """
-    global klass, generic_klass_types
-    
-    start_header = end_header = 0
-    
-    # imports
-    start_import = peek("IMPORT", "PACKAGE")
-    end_import = None
-    while maybe("IMPORT", "PACKAGE"):  
-        maybe("DEF_MODIFIER") # static
-        repeat(lambda: maybe("PERIOD", "ID", "MUL"))
-        end_import = accept("SEMICOLON")
-    
-    klass.import_span = (
-        end_import and (start_import.lexpos, end_import.lexpos+1) or None
-    )
     
-    # public/private/static/abstract for class/interface
-    start_header = peek().lexpos
-    repeat(lambda: maybe("DEF_MODIFIER"))
-    
-    if accept("CLASS", "INTERFACE").type == "INTERFACE":
-        klass.is_interface = True
-    
-    # generic types in the class
-    klass.name, generic_part, _, _ = parse_type()
-    generic_klass_types = erase_types(generic_part, "$C%d")
-    
-    # extended classes
-    if not klass.is_interface:
-        if maybe("EXTENDS"):
-            parent_type, _, _, _ = parse_type()
-            klass.parents.add(parent_type)
-    
-    # implemented interfaces
-    if maybe(klass.is_interface and "EXTENDS" or "IMPLEMENTS"):
-        cont = True
-        while cont:
-            parent_type, _, _, _ = parse_type()
-            klass.parents.add(parent_type)
-            cont = maybe("COMMA")
-    
-    #print "SUPERTYPES:", klass.parents
-    end_header = peek().lexpos
-    parse_class_body()
+    def __init__(self):
+        self.tokens = None
+        self.types = None # self.tokens.types
+        self.num_tokens = 0
+        self.pos = 0
+        self.klass = None
+        self.generic_klass_types = None
+        self.seen_klass_states = False
+        self.header_only = False
+    
+    def parse_file(self, file_path, source=None, header_only=False):
+        """
+        parse_file(string[, string[, Bool]]) -> JavaType | None
+        
+        Parse a Java file into a JavaType. If source is given then it is
+        used as the contents of the file instead of reading the file.
+        Returns None if the file could not be parsed.
+        """
+        if source is None:
+            with open(file_path) as f:
+                source = f.read()
+        return self.parse_string(source, file_path, header_only)
+    
+    def parse_string(self, source, file_path="<string>", header_only=False):
+        """
+        parse_string(string[, string[, Bool]]) -> JavaType | None
+        
+        Parse the source code of a Java file into a JavaType. The file
+        path is only used for naming the type's file and in messages.
+        Returns None if the source could not be parsed.
+        
+        If header_only is true then only the imports and the class header
+        (name, kind and supertypes) are parsed; the type has no states
+        or methods, and its is_header_only is true. None of the class
+        body is lexed.
+        """
+        self.klass = JavaType(file_path)
+        self.klass.source = source
+        self.klass.is_header_only = header_only
+        self.generic_klass_types = None
+        self.seen_klass_states = False
+        self.header_only = header_only
+        
+        try:
+            self.tokens = TokenArray(source, make_scanner())
+            self.types = self.tokens.types
+            self.num_tokens = len(self.types)
+            self.pos = 1
+            self.parse_class_file()
+            print header_only and "Scanned file:" or "Parsed file:", file_path
+        except ParseError, e:
+            sys.stderr.write("Parse Error: %s \n" % e)
+            return None
+        except NoTokensLeftException, e:
+            sys.stderr.write(
+                "Parse Error: Unexpected end of input in file %s. \n"
+                % self.klass.file
+            )
+            return None
+        return self.klass
     
-    klass.header_span = (start_header, end_header)
+    # ------------------------------------------------------------------
 
-def parse_class_body():
-    """
-    parse_class_body(void) -> void
-    
-    Parse the body of a Java interface or class. This starts from the
-    first { and goes until the final }
-    """
-    accept("LBRACE")
-    while not maybe("RBRACE"):
-    
-        # state list
-        if maybe("STATES"):
-            global seen_klass_states
-            
-            if seen_klass_states:
-                raise ParseError(
-                    "Class state set already defined in %s." % klass.file
-                )
-            elif klass.is_interface:
-                raise ParseError(
-                    "Interface cannot have state set in %s." % klass.file
-                )
-                
-            seen_klass_states = True
-            accept("LBRACE")
-            parse_states(klass.states)
-            accept("RBRACE")
-            #print "STATES:", klass.states
-        
-        # method or attribute
-        elif peek("DEF_MODIFIER"):
-            
-            start_header = peek("DEF_MODIFIER").lexpos
-            end_header = 0
-            
-            inherit, can_have_states = parse_modifiers()
-            inferred_types = { }
-            is_method = False
-            can_have_states = can_have_states and not klass.is_interface
+    def peek_token(self):
+        if self.pos >= self.num_tokens:
+            self.num_tokens = self.tokens.fill(self.pos)
+            if self.pos >= self.num_tokens:
+                raise NoTokensLeftException()
+        return self.pos
+
+    def get_token(self):
+        tok = self.peek_token()
+        self.pos += 1
+        return tok
+
+    def accept(self, *types):
+        tok = self.get_token()
+        if len(types) and token_names[self.types[tok]] not in types:
+            raise ParseError(
+                ("Unexpected token '%s' of type '%s', expected type of " +
+                 "%s in %s:%d")
+                % (self.tokens.value(tok), self.tokens.type(tok), types, 
+                   self.klass.file, self.tokens.line(tok))
+            )
+        return tok
+
+    def maybe(self, *types):
+        tok = self.peek_token()
+        if token_names[self.types[tok]] not in types:
+            return False
+        self.pos += 1
+        return tok
+
+    def peek(self, *types):
+        tok = self.peek_token()
+        if not len(types) or token_names[self.types[tok]] in types:
+            return tok
+        return False
+
+    # ------------------------------------------------------------------
+
+    def erased_type(self, type_name, inferred_method_types):
+        """
+        erased_type(string, {}) -> string
+
+        Return the erased type for type_name.
+        """
+
+        # look at the non-array portion
+        if type_name in self.generic_klass_types:
+            return self.generic_klass_types[type_name]
+        elif type_name in inferred_method_types:
+            return inferred_method_types[type_name]
+
+        return type_name
+
+    # ------------------------------------------------------------------
+
+    def parse_class_file(self):
+        """
+        parse_class_file(void) -> void
+
+        Parse a Java class file. A class file can contain a series of
+        imports followed by either a class or interface definition.
+        """
+
+        start_header = end_header = 0
+
+        # imports
+        start_import = self.peek("IMPORT", "PACKAGE")
+        end_import = None
+        while True:
+            kind = self.maybe("IMPORT", "PACKAGE")
+            if not kind:
+                break
+            self.maybe("DEF_MODIFIER") # static
+            name = [ ]
+            part = self.maybe("PERIOD", "ID", "MUL")
+            while part:
+                name.append(self.tokens.value(part))
+                part = self.maybe("PERIOD", "ID", "MUL")
+            end_import = self.accept("SEMICOLON")
             
-            # we are looking at a method that has some inferred types
-            if peek("LT"):
-                is_method = True
-                inferred_types = erase_types(
-                    parse_parameratization(), 
-                    "$M%d"
-                )
+            if self.tokens.type(kind) == "PACKAGE":
+                self.klass.package = "".join(name)
+            else:
+                self.klass.imports.append("".join(name))
 
-            # type of param / method
-            return_type = erased_type(parse_type()[0], inferred_types)
+        self.klass.import_span = (
+            end_import and 
+            (self.tokens.lexpos[start_import], 
+             self.tokens.lexpos[end_import]+1) or 
+            None
+        )
 
-            # are we looking at a constructor?
-            is_constructor = False
-            paren = peek("LPAREN")
-            if paren:
-                if return_type != klass.name:
+        # public/private/static/abstract for class/interface
+        start_header = self.tokens.lexpos[self.peek()]
+        repeat(lambda: self.maybe("DEF_MODIFIER"))
+
+        if self.tokens.type(self.accept("CLASS", "INTERFACE")) == "INTERFACE":
+            self.klass.is_interface = True
+
+        # generic types in the class
+        self.klass.name, generic_part, _, _ = self.parse_type()
+        self.generic_klass_types = erase_types(generic_part, "$C%d")
+
+        # extended classes
+        if not self.klass.is_interface:
+            if self.maybe("EXTENDS"):
+                parent_type, _, _, _ = self.parse_type()
+                self.klass.parents.add(parent_type)
+
+        # implemented interfaces
+        if self.maybe(self.klass.is_interface and "EXTENDS" or "IMPLEMENTS"):
+            cont = True
+            while cont:
+                parent_type, _, _, _ = self.parse_type()
+                self.klass.parents.add(parent_type)
+                cont = self.maybe("COMMA")
+
+        #print "SUPERTYPES:", self.klass.parents
+        end_header = self.tokens.lexpos[self.peek()]
+        self.klass.header_span = (start_header, end_header)
+        if not self.header_only:
+            self.parse_class_body()
+
+    def parse_class_body(self):
+        """
+        parse_class_body(void) -> void
+
+        Parse the body of a Java interface or class. This starts from the
+        first { and goes until the final }
+        """
+        self.accept("LBRACE")
+        while not self.maybe("RBRACE"):
+
+            # state list
+            if self.maybe("STATES"):
+
+                if self.seen_klass_states:
                     raise ParseError(
-                        "Method missing return type in %s:%d."
-                        % (klass.file, paren.lineno)
+                        "Class state set already defined in %s." 
+                        % self.klass.file
                     )
-                is_method = is_constructor = True
-                name = return_type
-                return_type = "$Self"
-            else:
-                name = accept("ID").value
-                is_constructor = False
-            
-            if is_method or peek("LPAREN"):
-                
-                line_num = peek().lineno
-                
-                # method parameters
-                param_types, param_names, type_bounds = parse_method_params(
+                elif self.klass.is_interface:
+                    raise ParseError(
+                        "Interface cannot have state set in %s." 
+                        % self.klass.file
+                    )
+
+                self.seen_klass_states = True
+                self.accept("LBRACE")
+                self.parse_states(self.klass.states)
+                self.accept("RBRACE")
+                #print "STATES:", self.klass.states
+
+            # method or attribute
+            elif self.peek("DEF_MODIFIER"):
+
+                start_header = self.tokens.lexpos[self.peek("DEF_MODIFIER")]
+                end_header = 0
+
+                inherit, can_have_states = self.parse_modifiers()
+                inferred_types = { }
+                is_method = False
+                can_have_states = (
+                    can_have_states and not self.klass.is_interface
+                )
+
+                # we are looking at a method that has some inferred types
+                if self.peek("LT"):
+                    is_method = True
+                    inferred_types = erase_types(
+                        self.parse_parameratization(), 
+                        "$M%d"
+                    )
+
+                # type of param / method
+                return_type = self.erased_type(
+                    self.parse_type()[0], 
                     inferred_types
                 )
-                end_header = peek().lexpos - 1
-                
-                # state transitions
-                transitions = None                
-                if can_have_states:
-                    # starting state for the class constructor, no trans
-                    if is_constructor:
-                        if peek("STATE"):
-                            state = accept("STATE").value
-                            name = "$C" # normalize constructor name
-                            klass.constructor_states.add(state)
-                            transitions = [(Set(("$0",)), state)]
-
-                    # normal public method
-                    else:
-                        transitions = parse_method_states()
-                
-                # method body
-                start_body = end_body = 0
-                if not klass.is_interface:
-                    start_body, end_body = parse_method_body()
+
+                # are we looking at a constructor?
+                is_constructor = False
+                paren = self.peek("LPAREN")
+                if paren:
+                    if return_type != self.klass.name:
+                        raise ParseError(
+                            "Method missing return type in %s:%d."
+                            % (self.klass.file, self.tokens.line(paren))
+                        )
+                    is_method = is_constructor = True
+                    name = return_type
+                    return_type = "$Self"
                 else:
-                    accept("SEMICOLON")
-                
-                # add the method to the type
-                types = [return_type,]
-                types.extend(param_types or [ ])
-                
-                if not can_have_states:
-                    klass.add_non_state_method(
-                        (start_header, end_header),
-                        (start_body, end_body),
-                        name,
-                        tuple(types)
+                    name = self.tokens.value(self.accept("ID"))
+                    is_constructor = False
+
+                if is_method or self.peek("LPAREN"):
+
+                    line_num = self.tokens.line(self.peek())
+
+                    # method parameters
+                    param_types, param_names, type_bounds = (
+                        self.parse_method_params(inferred_types)
                     )
+                    end_header = self.tokens.lexpos[self.peek()] - 1
+
+                    # state transitions
+                    transitions = None                
+                    if can_have_states:
+                        # starting state for the class constructor, no trans
+                        if is_constructor:
+                            if self.peek("STATE"):
+                                state = self.tokens.value(
+                                    self.accept("STATE")
+                                )
+                                name = "$C" # normalize constructor name
+                                self.klass.constructor_states.add(state)
+                                transitions = [(Set(("$0",)), state)]
+
+                        # normal public method
+                        else:
+                            transitions = self.parse_method_states()
+
+                    # method body
+                    start_body = end_body = 0
+                    if not self.klass.is_interface:
+                        start_body, end_body = self.parse_method_body()
+                    else:
+                        self.accept("SEMICOLON")
+
+                    # add the method to the type
+                    types = [return_type,]
+                    types.extend(param_types or [ ])
+
+                    if not can_have_states:
+                        self.klass.add_non_state_method(
+                            (start_header, end_header),
+                            (start_body, end_body),
+                            name,
+                            tuple(types)
+                        )
+                    else:
+                        self.klass.add_state_method(JavaMethod(
+                            name = name,
+
+                            # type signature of this method, this includes
+                            # return type and param types
+                            signature = tuple(types),
+
+                            # names of the parameters, needed for state
+                            # method specialization (when calling parent
+                            # method) and for param renaming (when two
+                            # methods with the same name/signature need to
+                            # by merged but accept different parameter
+                            # names)
+                            param_names = param_names,
+
+                            # the lexical bounds around the method param
+                            # types, needed for param renaming
+                            type_bounds = type_bounds, 
+
+                            # positional info
+                            line = line_num,
+                            file = self.klass.file,
+                            is_constructor = is_constructor,
+                            klass = self.klass,
+                            transitions = transitions,
+                            can_have_states = can_have_states,
+
+                            # lexical spans of the header and body of this
+                            # method
+                            header_span = (start_header, end_header),
+                            body_span = (start_body, end_body)
+                        ))
+
+                # go and find the end of this parameter declaration. this
+                # does scans until it finds the first semicolon and then
+                # accepts it as the end
                 else:
-                    klass.add_state_method(JavaMethod(
-                        name = name,
-                        
-                        # type signature of this method, this includes
-                        # return type and param types
-                        signature = tuple(types),
-                        
-                        # names of the parameters, needed for state
-                        # method specialization (when calling parent
-                        # method) and for param renaming (when two
-                        # methods with the same name/signature need to
-                        # by merged but accept different parameter
-                        # names)
-                        param_names = param_names,
-                        
-                        # the lexical bounds around the method param
-                        # types, needed for param renaming
-                        type_bounds = type_bounds, 
-                        
-                        # positional info
-                        line = line_num,
-                        file = klass.file,
-                        is_constructor = is_constructor,
-                        klass = klass,
-                        transitions = transitions,
-                        can_have_states = can_have_states,
-                        
-                        # lexical spans of the header and body of this
-                        # method
-                        header_span = (start_header, end_header),
-                        body_span = (start_body, end_body)
-                    ))
-            
-            # go and find the end of this parameter declaration. this
-            # does scans until it finds the first semicolon and then
-            # accepts it as the end
+                    end_header = self.accept("EQUALS", "SEMICOLON")
+                    if self.tokens.type(end_header) == "EQUALS":
+                        self.num_tokens = self.tokens.skip_to(
+                            end_header, 
+                            skip_statement
+                        )
+                        end_header = self.accept("SEMICOLON")
+                    end_header = self.tokens.lexpos[end_header]+1
+                    self.klass.add_param(name, (start_header, end_header))
             else:
-                end_header = accept("EQUALS", "SEMICOLON")
-                if end_header.type == "EQUALS":
-                    repeat(lambda: (not peek("SEMICOLON")) and accept())
-                    end_header = accept("SEMICOLON")
-                end_header = end_header.lexpos+1
-                klass.add_param(name, (start_header, end_header))
-        else:
-            tok = peek()
-            raise ParseError(
-                "Unexpected token '%s' of type '%s' found in class body."
-                % (tok.value, tok.type)
-            )
+                tok = self.peek()
+                raise ParseError(
+                    "Unexpected token '%s' of type '%s' found in class body."
+                    % (self.tokens.value(tok), self.tokens.type(tok))
+                )
 
-def parse_method_body():
-    """
-    perse_method_body(void) -> (int, int)
-    
-    Consume tokens until what looks like the end of the method is 
-    reached. Return the pair of start and end offsets.
-    """
-    start = accept("LBRACE")
-    brace_count = 0
-    
-    while True:
-        tok = accept()
-        if tok.type == "LBRACE":
-            brace_count += 1
-        elif tok.type == "RBRACE":
-            brace_count -= 1
-            if brace_count < 0:
-                pushback_token(tok)
-                break
-    
-    return start.lexpos, accept("RBRACE").lexpos
+    def parse_method_body(self):
+        """
+        perse_method_body(void) -> (int, int)
 
-def parse_method_states():
-    """
-    parse_method_states() -> (Set | None, string | None)
-    
-    Parse the state transitions for a method.
-    """
-    transitions = [ ]
-    next_is_state = peek("MUL", "STATE")    
-    from_states = klass.states # default for identity
-    to_state = None
-    found_states = False
-    
-    while next_is_state:
-        found_states = True
-        if next_is_state.type == "MUL":
-            accept("MUL")
-        else:
-            from_states = Set()
-            parse_states(from_states)
-        accept("STATE_TRANS")
-        transitions.append((from_states, accept("STATE").value))
-        next_is_state = maybe("SEMICOLON") and peek("MUL", "STATE") or False
-    
-    return transitions
+        Consume tokens until what looks like the end of the method is 
+        reached. Return the pair of start and end offsets.
+        """
+        start = self.accept("LBRACE")
+        self.num_tokens = self.tokens.skip_to(start, skip_block)
 
-def parse_method_params(inferred_method_types):
-    """
-    parse_method_params(dict) -> (tuple, tuple)
-    
-    Parse out the list of method parameters and return the erased base
-    types as a tuple. If void is the only type, or there are no types,
-    then return an empty tuple.
-    """
-    global generic_klass_types
-    
-    accept("LPAREN")
-    types = [ ]
-    names = [ ]
-    bounds = [ ]
-    
-    next = peek()
-    if (next.type == "ID" and next.value != "void") or next.type != "RPAREN":
-        cont = True
+        return (
+            self.tokens.lexpos[start], 
+            self.tokens.lexpos[self.accept("RBRACE")]
+        )
+
+    def parse_method_states(self):
+        """
+        parse_method_states() -> (Set | None, string | None)
+
+        Parse the state transitions for a method.
+        """
+        transitions = [ ]
+        next_is_state = self.peek("MUL", "STATE")    
+        from_states = self.klass.states # default for identity
+        to_state = None
+        found_states = False
+
+        while next_is_state:
+            found_states = True
+            if self.tokens.type(next_is_state) == "MUL":
+                self.accept("MUL")
+            else:
+                from_states = Set()
+                self.parse_states(from_states)
+            self.accept("STATE_TRANS")
+            transitions.append((
+                from_states, 
+                self.tokens.value(self.accept("STATE"))
+            ))
+            next_is_state = (
+                self.maybe("SEMICOLON") and self.peek("MUL", "STATE") or False
+            )
+
+        return transitions
+
+    def parse_method_params(self, inferred_method_types):
+        """
+        parse_method_params(dict) -> (tuple, tuple)
+
+        Parse out the list of method parameters and return the erased base
+        types as a tuple. If void is the only type, or there are no types,
+        then return an empty tuple.
+        """
+
+        self.accept("LPAREN")
+        types = [ ]
+        names = [ ]
+        bounds = [ ]
+
+        next = self.peek()
+        next_type = self.tokens.type(next)
+        if ((next_type == "ID" and self.tokens.value(next) != "void") or 
+            next_type != "RPAREN"):
+            cont = True
+            while cont:
+                type_name, _, array_part, type_bounds = self.parse_type()
+                bounds.append(type_bounds)
+                names.append(self.tokens.value(self.accept("ID")))
+                type_name = self.erased_type(type_name, inferred_method_types)
+                if array_part:
+                    type_name += "[]" * len(array_part)
+                types.append(type_name)
+                cont = self.maybe("COMMA")
+
+        self.accept("RPAREN")
+
+        return tuple(types), tuple(names), bounds
+
+    def parse_states(self, set):
+        """
+        parse_states(Set) -> void
+
+        Parse a list of zero or more comma separated states.
+        """
+        cont = self.peek("STATE")
         while cont:
-            type_name, _, array_part, type_bounds = parse_type()
-            bounds.append(type_bounds)
-            names.append(accept("ID").value)
-            type_name = erased_type(type_name, inferred_method_types)
-            if array_part:
-                type_name += "[]" * len(array_part)
-            types.append(type_name)
-            cont = maybe("COMMA")
-    
-    accept("RPAREN")
-    
-    return tuple(types), tuple(names), bounds
+            set.add(self.tokens.value(self.accept("STATE")))
+            cont = self.maybe("COMMA")
+
+    def parse_modifiers(self):
+        """
+        parse_modifiers(void) -> Bool
+
+        Consume one or more visibility modifiers (public, private, protected,
+        static, abstract) and return whether or not a modifier from the list
+        of inherited_modifiers was consumed.
+        """
+        seen = has_stateful = False
+        not_static = True
+        mod = self.accept("DEF_MODIFIER")
+        while mod:
+            mod = self.tokens.value(mod)
+            not_static = mod != "static" and not_static
+            seen = seen or mod in inherited_modifiers
+            has_stateful = (has_stateful or mod in stateful_modifiers)
+            mod = self.maybe("DEF_MODIFIER")
+
+        return not_static and seen, not_static and has_stateful
+
+    def parse_type(self):
+        """
+        parse_type(void) -> (string, list | Bool, tuple | Bool)
+
+        Parse a Java type. A type is an identifier followed by an optional
+        generic component, followed by an optional array component.
+        """
+        type_ident = self.accept("ID")
+        return (
+            self.tokens.value(type_ident),
+            self.peek("LT") and self.parse_parameratization(),
+            self.peek("LBRACKET") and self.parse_array_bounds(),
+            (self.tokens.lexpos[type_ident], 
+             self.tokens.lexpos[self.peek()] - 1),
+        )
 
-def parse_states(set):
-    """
-    parse_states(Set) -> void
-    
-    Parse a list of zero or more comma separated states.
-    """
-    cont = peek("STATE")
-    while cont:
-        set.add(accept("STATE").value)
-        cont = maybe("COMMA")
-    
-def parse_modifiers():
-    """
-    parse_modifiers(void) -> Bool
-    
-    Consume one or more visibility modifiers (public, private, protected,
-    static, abstract) and return whether or not a modifier from the list
-    of inherited_modifiers was consumed.
-    """
-    global inherited_modifiers, stateful_modifiers
-    seen = has_stateful = False
-    not_static = True
-    mod = accept("DEF_MODIFIER")
-    while mod:
-        not_static = mod.value != "static" and not_static
-        seen = seen or mod.value in inherited_modifiers
-        has_stateful = (has_stateful or mod.value in stateful_modifiers)
-        mod = maybe("DEF_MODIFIER")
-        
-    return not_static and seen, not_static and has_stateful
+    def parse_parameratization(self):
+        """
+        parse_parameratization(void) -> list
 
-def parse_type():
-    """
-    parse_type(void) -> (string, list | Bool, tuple | Bool)
-    
-    Parse a Java type. A type is an identifier followed by an optional
-    generic component, followed by an optional array component.
-    """
-    type_ident = accept("ID")
-    return (
-        type_ident.value,
-        peek("LT") and parse_parameratization(),
-        peek("LBRACKET") and parse_array_bounds(),
-        (type_ident.lexpos, peek().lexpos - 1),
-    )
-    
-def parse_parameratization():
-    """
-    parse_parameratization(void) -> list
-    
-    Parse Java type parameters and return a tree of said parameters.
-    """
-    accept("LT")
-    cont = True
-    parts = [ ]
-    while cont:
-        parts.append(parse_type())
-        cont = maybe("COMMA")
-    accept("GT")
-    return parts
-
-def parse_array_bounds():
-    """
-    parse_array(void) -> tupe
-    
-    Parse the array component of a type, and record the bounds therein.
-    If a part is given no bound then -1 is used, otherwise the integer
-    value is recorded.
-    """
-    bounds = [ ]
-    while maybe("LBRACKET"):
-        bound = maybe("NUMBER")
-        bounds.append(bound and int(bound.value) or -1)
-        accept("RBRACKET")
-    return tuple(bounds)
+        Parse Java type parameters and return a tree of said parameters.
+        """
+        self.accept("LT")
+        cont = True
+        parts = [ ]
+        while cont:
+            parts.append(self.parse_type())
+            cont = self.maybe("COMMA")
+        self.accept("GT")
+        return parts
+
+    def parse_array_bounds(self):
+        """
+        parse_array(void) -> tupe
+
+        Parse the array component of a type, and record the bounds therein.
+        If a part is given no bound then -1 is used, otherwise the integer
+        value is recorded.
+        """
+        bounds = [ ]
+        while self.maybe("LBRACKET"):
+            bound = self.maybe("NUMBER")
+            bounds.append(bound and int(self.tokens.value(bound)) or -1)
+            self.accept("RBRACKET")
+        return tuple(bounds)
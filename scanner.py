@@ -0,0 +1,210 @@
+# ----------------------------------------------------------------------
+# StateJava: scanner.py
+#
+# Copyright (C) 2009, 
+# Peter Goodman,
+# All rights reserved.
+#
+# Hand-written scanner for the State Java language. This produces the
+# same tokens as the PLY lexer built from lexer.py, but does it in one
+# regular expression match per token and writes the tokens straight
+# into a TokenArray.
+#
+# ----------------------------------------------------------------------
+
+from __future__ import with_statement
+from token_array import TokenArray, PlyScanner, token_codes, fill_stop_codes
+import lexer, re, os, sys, time
+
+# one alternative per kind of token. the alternatives are tried in the
+# same order as the PLY lexer tries the rules in lexer.py; see the
+# lexer for why e.g. NUMBER comes before ADD, SUB and PERIOD.
+ID, NUMBER, CHAR, STRING, STATE, IGNORE, PUNCT = range(1, 8)
+scan_re = re.compile(r"""
+    ( [a-zA-Z_]+ )
+  | ( [-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)? )
+  | ( '[^'\\\n]*(?:\\.[^'\\\n]*)*' )
+  | ( "[^"\\\n]*(?:\\.[^"\\\n]*)*" )
+  | ( :[a-zA-Z0-9_]+ )
+  | ( [ \t\r\n]+ | /\*[\s\S]*?\*/ | //[^\n]* )
+  | ( \.\.\. | <= | >= | -> | != | [-+*/%<>=.,;:?(){}\[\]] )
+""", re.X)
+
+# token codes of reserved words and punctuation, by their text
+reserved_codes = dict(
+    (word, token_codes[name]) for word, name in lexer.reserved.items()
+)
+punct_codes = {
+    "...": token_codes["ELLIPSIS"], "<=": token_codes["LT_EQUALS"],
+    ">=": token_codes["GT_EQUALS"], "->": token_codes["STATE_TRANS"],
+    "!=": token_codes["NOT_EQUALS"], "-": token_codes["SUB"],
+    "+": token_codes["ADD"], "*": token_codes["MUL"],
+    "/": token_codes["DIV"], "%": token_codes["MOD"],
+    "<": token_codes["LT"], ">": token_codes["GT"],
+    "=": token_codes["EQUALS"], ".": token_codes["PERIOD"],
+    ",": token_codes["COMMA"], ";": token_codes["SEMICOLON"],
+    ":": token_codes["COLON"], "?": token_codes["QUESTION_MARK"],
+    "(": token_codes["LPAREN"], ")": token_codes["RPAREN"],
+    "{": token_codes["LBRACE"], "}": token_codes["RBRACE"],
+    "[": token_codes["LBRACKET"], "]": token_codes["RBRACKET"],
+}
+kind_codes = {
+    NUMBER: token_codes["NUMBER"], CHAR: token_codes["CHAR"],
+    STRING: token_codes["STRING"], STATE: token_codes["STATE"],
+}
+
+class Scanner(object):
+    """
+    Scanner for State Java source code. This has the same interface as
+    PlyScanner; see TokenArray.
+    """
+
+    def __init__(self):
+        self.source = ""
+        self.lexpos = 0
+
+    def input(self, source):
+        self.source = source
+        self.lexpos = 0
+
+    def seek(self, lexpos):
+        self.lexpos = lexpos
+
+    def scan(self, tokens, i, n):
+        """
+        scan(TokenArray, int, int) -> Bool
+
+        Scan tokens into the token arrays until there are n tokens, or
+        until a token in fill_stop_codes is the ith token or later.
+        Returns False if the end of the input was reached.
+        """
+        types, lexpos, ends = tokens.types, tokens.lexpos, tokens.ends
+        stop_codes = fill_stop_codes
+        source = self.source
+        pos = self.lexpos
+        source_len = len(source)
+        match = scan_re.match
+        num_tokens = len(types)
+
+        while num_tokens < n:
+            if pos >= source_len:
+                self.lexpos = pos
+                return False
+
+            m = match(source, pos)
+            if not m:
+                print "Scanner Error: illegal character '%s'." % source[pos]
+                pos += 1
+                continue
+
+            kind = m.lastindex
+            end = m.end()
+            if kind == ID:
+                code = reserved_codes.get(m.group(ID), token_codes["ID"])
+            elif kind == PUNCT:
+                code = punct_codes[m.group(PUNCT)]
+            elif kind == IGNORE:
+                pos = end
+                continue
+            else:
+                code = kind_codes[kind]
+
+            types.append(code)
+            lexpos.append(pos)
+            ends.append(end)
+            num_tokens += 1
+            pos = end
+            if code in stop_codes and num_tokens > i:
+                break
+
+        self.lexpos = pos
+        return True
+
+# ----------------------------------------------------------------------
+
+def scan_all(source, scanner):
+    """
+    scan_all(string, Scanner | PlyScanner) -> TokenArray
+
+    Scan all of source into a token array.
+    """
+    tokens = TokenArray(source, scanner)
+    while not tokens.done:
+        tokens.fill(len(tokens))
+    return tokens
+
+def read_sources(paths):
+    """
+    read_sources(list) -> list
+
+    Read the source code of every .java file under each of the paths.
+    """
+    sources = [ ]
+    for path in paths:
+        for dir_name, _, file_names in os.walk(path):
+            for file_name in file_names:
+                if file_name.endswith(".java"):
+                    with open(os.path.join(dir_name, file_name)) as f:
+                        sources.append(f.read())
+    return sources
+
+def test_scanner(paths):
+    """
+    test_scanner(list) -> Bool
+
+    Check that the hand-written scanner produces exactly the same tokens
+    (types and offsets) as the PLY lexer for every .java file under each
+    of the paths, as well as for a few tricky inputs.
+    """
+    from parser import get_lexer
+    sources = [
+        "a-1 a->b x.5 ... <=>= !=! 1.2e+3 .e 1e :A :: foo1 a_b",
+        "'a' '\\'' \"a\\\"b\" \"unterminated\n'\n\"\" /* a\n*/ // x\n/",
+        "@ # $ & | ^ ~ \\ if else elseif states package",
+        "",
+    ]
+    sources.extend(read_sources(paths))
+
+    failed = 0
+    for source in sources:
+        expected = scan_all(source, PlyScanner(get_lexer().clone()))
+        got = scan_all(source, Scanner())
+        for field in ("types", "lexpos", "ends"):
+            if getattr(expected, field) != getattr(got, field):
+                print "Mismatch in token %s for: %r" % (field, source[:60])
+                failed += 1
+                break
+
+    print "Scanned %d inputs; %d mismatches." % (len(sources), failed)
+    return not failed
+
+def bench_scanner(paths, repeat=5):
+    """
+    bench_scanner(list[, int]) -> void
+
+    Measure the throughput of the PLY lexer and the hand-written scanner
+    over all .java files under each of the paths.
+    """
+    from parser import get_lexer
+    sources = read_sources(paths)
+    size = sum(len(source) for source in sources)
+
+    for name, make_scanner in (
+        ("ply", lambda: PlyScanner(get_lexer().clone())),
+        ("hand-written", Scanner),
+    ):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for source in sources:
+                scan_all(source, make_scanner())
+            elapsed = time.time() - start
+            best = best is None and elapsed or min(best, elapsed)
+        print "%-12s %8.3fs %8.2f MB/s" % (
+            name, best, size / (best * 1024.0 * 1024.0)
+        )
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or ["./example", "./test"]
+    if test_scanner(paths):
+        bench_scanner(paths)
@@ -0,0 +1,247 @@
+# ----------------------------------------------------------------------
+# StateJava: token_array.py
+#
+# Copyright (C) 2009, 
+# Peter Goodman,
+# All rights reserved.
+#
+# Compact storage for the tokens of a source file. Tokens are kept in
+# parallel arrays and referred to by their index. This also has the
+# scanners used to skip over method bodies and field initializers
+# without tokenizing them.
+#
+# ----------------------------------------------------------------------
+
+from array import array
+from bisect import bisect_right
+import lexer, re
+
+# token type names and their codes in TokenArray.types
+token_names = tuple(sorted(lexer.tokens))
+token_codes = dict((name, code) for code, name in enumerate(token_names))
+
+# number of tokens lexed at a time when the parser needs more. a batch
+# ends early at any token that the parser might skip the source after
+# so that no part of a method body or field initializer is lexed.
+fill_size = 64
+fill_stop_codes = (token_codes["LBRACE"], token_codes["EQUALS"])
+
+# things that can hide a brace or semicolon from the skipping scanners:
+# string and char literals, and comments. this follows the STRING,
+# CHAR and COMMENT rules in lexer.py.
+hidden_re = (
+    r'"(?:[^\\\n]|\\.)*?"|' +
+    r"'(?:[^\\\n]|\\.)*?'|" +
+    r'/\*.*?\*/|' +
+    r'//[^\n]*|'
+)
+block_re = re.compile(hidden_re + r'([{}])', re.S)
+statement_re = re.compile(hidden_re + r'(;)', re.S)
+newline_re = re.compile(r'\n')
+
+# the start of a states block or of a state name, e.g. in a method's
+# transitions. this also matches things like "x ?a:b" in method bodies
+# which is fine for its use in has_state_syntax.
+state_syntax_re = re.compile(
+    hidden_re + r'(\bstates\s*\{|:[a-zA-Z0-9_])', re.S
+)
+
+def skip_block(source, pos):
+    """
+    skip_block(string, int) -> int
+
+    Find the '}' that closes a block whose '{' ends just before pos in
+    source. Returns the offset of the '}', or -1 if the block is never
+    closed. Braces in strings, chars and comments are ignored.
+    """
+    depth = 0
+    for m in block_re.finditer(source, pos):
+        c = m.group(1)
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            if not depth:
+                return m.start()
+            depth -= 1
+    return -1
+
+def skip_statement(source, pos):
+    """
+    skip_statement(string, int) -> int
+
+    Find the offset of the first ';' at or after pos in source that is
+    not in a string, char or comment. Returns -1 if there is none.
+    """
+    for m in statement_re.finditer(source, pos):
+        if m.group(1):
+            return m.start()
+    return -1
+
+def has_state_syntax(source):
+    """
+    has_state_syntax(string) -> Bool
+
+    Check if source might declare states or use them. This can give
+    false positives but not false negatives, and is much cheaper than
+    parsing the source.
+    """
+    for m in state_syntax_re.finditer(source):
+        if m.group(1):
+            return True
+    return False
+
+class PlyScanner(object):
+    """
+    Adapts a PLY lexer (a clone of the master lexer) to the interface
+    that TokenArray uses to fill its arrays.
+    """
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+
+    def input(self, source):
+        self.lexer.input(source)
+
+    def seek(self, lexpos):
+        """
+        seek(int) -> void
+
+        Continue lexing from offset lexpos.
+        """
+        self.lexer.lexpos = lexpos
+
+    def scan(self, tokens, i, n):
+        """
+        scan(TokenArray, int, int) -> Bool
+
+        Lex tokens into the token arrays until there are n tokens, or
+        until a token in fill_stop_codes is the ith token or later.
+        Returns False if the end of the input was reached.
+        """
+        types, lexpos, ends = tokens.types, tokens.lexpos, tokens.ends
+        lexer = self.lexer
+        token = lexer.token
+
+        while len(types) < n:
+            tok = token()
+            if not tok:
+                return False
+            code = token_codes[tok.type]
+            types.append(code)
+            lexpos.append(tok.lexpos)
+            ends.append(lexer.lexpos)
+            if code in fill_stop_codes and len(types) > i:
+                break
+
+        return True
+
+class TokenArray(object):
+    """
+    The tokens of a source file, stored as parallel arrays of token
+    type codes, start offsets (lexpos) and end offsets. A token is
+    identified by its index into these arrays. Line numbers are not
+    stored; they are found from the offsets of the newlines in the
+    source, which are only collected if a line number is asked for.
+
+    Index 0 holds a placeholder token so that the index of every real
+    token is true; indices can be used in place of token objects in
+    tests like "if maybe(...)". The real tokens are 1 through len - 1.
+
+    Tokens are lexed a few at a time as they are needed, so that parts
+    of the source can be skipped over without being lexed at all.
+    """
+
+    def __init__(self, source, scanner):
+        """
+        TokenArray(string, PlyScanner | Scanner)
+
+        Make a token array that lexes source using the scanner. The
+        scanner must not be used for anything else.
+        """
+        self.source = source
+        self.scanner = scanner
+        self.done = False
+        self.types = array('B', [0])
+        self.lexpos = array('l', [0])
+        self.ends = array('l', [0])
+        self.newlines = None
+        scanner.input(source)
+
+    def __len__(self):
+        return len(self.types)
+
+    def fill(self, i):
+        """
+        fill(int) -> int
+
+        Lex more tokens so that (if the input is long enough) the ith
+        token exists. Returns the number of tokens in the arrays.
+        """
+        if not self.done:
+            n = max(i + 1, len(self.types) + fill_size)
+            self.done = not self.scanner.scan(self, i, n)
+        return len(self.types)
+
+    def skip_to(self, i, skip):
+        """
+        skip_to(int, function) -> int
+
+        Skip the source after the ith token, up to the offset found by
+        calling skip(source, offset). The next token lexed after the
+        ith token is the one at that offset. Returns the new number of
+        tokens in the arrays.
+        """
+        source = self.source
+        start = self.ends[i]
+        end = skip(source, start)
+        if end < 0:
+            end = len(source)
+
+        # forget anything that was lexed after the ith token
+        del self.types[i + 1:]
+        del self.lexpos[i + 1:]
+        del self.ends[i + 1:]
+
+        self.scanner.seek(end)
+        self.done = False
+        return len(self.types)
+
+    def type(self, i):
+        """
+        type(int) -> string
+
+        Get the type name of the ith token.
+        """
+        return token_names[self.types[i]]
+
+    def value(self, i):
+        """
+        value(int) -> string
+
+        Get the text of the ith token.
+        """
+        return self.source[self.lexpos[i]:self.ends[i]]
+
+    def line(self, i):
+        """
+        line(int) -> int
+
+        Get the line number (starting at 1) that the ith token is on.
+        """
+        if self.newlines is None:
+            self.newlines = array('l', (
+                m.start() for m in newline_re.finditer(self.source)
+            ))
+        return bisect_right(self.newlines, self.lexpos[i]) + 1
+
+    def column(self, i):
+        """
+        column(int) -> int
+
+        Get the column number (starting at 1) of the start of the ith
+        token.
+        """
+        line = self.line(i)
+        if line == 1:
+            return self.lexpos[i] + 1
+        return self.lexpos[i] - self.newlines[line - 2]